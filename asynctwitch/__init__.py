@@ -1,6 +1,7 @@
-from .dataclasses import Badge, Emote, Color,\
-    Command, SubCommand, Message, User, Song, Object
+from .dataclasses import Badge, Emote, EmoteCatalogue, Color,\
+    Command, SubCommand, Message, User, Song, Object, ChannelState,\
+    MessageCache, UserRegistry, Roster, RosterDiff
 from .bots import Bot, CommandBot, CurrencyBot,\
-    ViewTimeBot, RankedBot
+    ViewTimeBot, RankedBot, ShardedRunner
 
 Colour = Color
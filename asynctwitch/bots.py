@@ -11,8 +11,18 @@ import subprocess
 import functools
 import sqlite3
 import pathlib
-
-from .dataclasses import Command, Message, User, Song
+import collections
+import bisect
+import heapq
+import random
+import itertools
+import multiprocessing
+import queue
+
+from .dataclasses import Command, Message, Song, ChannelState, \
+    MessageCache, UserRegistry, EmoteCatalogue
+from .storage import HistoryStore, MetadataCache, Database, db_method, \
+    AsyncDatabaseMethods, BalanceCache
 
 # Test if they have aiohttp installed in case they didn't use setup.py
 try:
@@ -24,6 +34,13 @@ except ImportError:
 
     aio_installed = False
 
+# Only used to speed up RankedBot.recompute_ranks
+try:
+    import numpy
+    numpy_installed = True
+except ImportError:
+    numpy_installed = False
+
 
 def db_setup(func):  # easy wrapper for setring up databases
     def inner(file):
@@ -36,40 +53,130 @@ def db_setup(func):  # easy wrapper for setring up databases
     return inner
 
 
-@db_setup
-def _setup_points_db(cursor):
-    cursor.execute("CREATE TABLE currency (username VARCHAR(30), balance INT)")
+def _create_currency_table(cursor):
+    cursor.execute(
+        "CREATE TABLE currency (username VARCHAR(30) PRIMARY KEY, "
+        "balance INT NOT NULL DEFAULT 0)")
+    cursor.execute("CREATE INDEX currency_balance ON currency (balance)")
+
+
+_setup_points_db = db_setup(_create_currency_table)
 
 
-@db_setup
-def _setup_ranks_db(cursor):
+def _migrate_points_db(con):
+    """ Give currency tables from older versions a primary key """
+    columns = con.execute("PRAGMA table_info(currency)").fetchall()
+    if any(c[1] == "username" and c[5] for c in columns):
+        with con:
+            con.execute("CREATE INDEX IF NOT EXISTS currency_balance "
+                        "ON currency (balance)")
+        return
+    with con:
+        con.execute("ALTER TABLE currency RENAME TO currency_old")
+        _create_currency_table(con.cursor())
+        # duplicate rows were always updated together, keep one of them
+        con.execute(
+            "INSERT INTO currency SELECT username, MAX(balance) "
+            "FROM currency_old GROUP BY username")
+        con.execute("DROP TABLE currency_old")
+
+
+def _create_rank_tables(cursor):
     cursor.execute(
         "CREATE TABLE user_ranks (username VARCHAR(30), rankname TEXT)")
     cursor.execute("CREATE TABLE currency_ranks (currency INT, rankname TEXT)")
     cursor.execute("CREATE TABLE watched_ranks (time INT, rankname TEXT)")
 
 
-@db_setup
-def _setup_time_db(cursor):
+_setup_ranks_db = db_setup(_create_rank_tables)
+
+
+def _migrate_ranks_db(con):
+    """ Index user ranks by username """
+    con.execute("CREATE INDEX IF NOT EXISTS user_ranks_username "
+                "ON user_ranks (username)")
+    con.commit()
+
+
+def _resolve_ranks(currency_ranks, watched_ranks, balances, times):
+    """ RankedBot.resolve_rank for many users at once """
+    if numpy_installed:
+        c = numpy.searchsorted(currency_ranks[0], balances, side="right")
+        w = numpy.searchsorted(watched_ranks[0], times, side="right")
+        currency_names = numpy.array([None] + currency_ranks[1], dtype=object)
+        watched_names = numpy.array([None] + watched_ranks[1], dtype=object)
+        return numpy.where(w > 0, watched_names[w],
+                           currency_names[c]).tolist()
+    ranks = []
+    for balance, watched in zip(balances, times):
+        i = bisect.bisect_right(watched_ranks[0], watched)
+        if i:
+            ranks.append(watched_ranks[1][i - 1])
+            continue
+        i = bisect.bisect_right(currency_ranks[0], balance)
+        ranks.append(currency_ranks[1][i - 1] if i else None)
+    return ranks
+
+
+def _create_time_table(cursor):
     cursor.execute(
-        "CREATE TABLE time_watched (username VARCHAR(30), time INT)")
+        "CREATE TABLE time_watched (username VARCHAR(30) PRIMARY KEY, "
+        "time INT NOT NULL DEFAULT 0)")
+    cursor.execute("CREATE INDEX time_watched_time ON time_watched (time)")
+
+
+_setup_time_db = db_setup(_create_time_table)
+
+
+def _migrate_time_db(con):
+    """ Give time tables from older versions a primary key """
+    columns = con.execute("PRAGMA table_info(time_watched)").fetchall()
+    if any(c[1] == "username" and c[5] for c in columns):
+        with con:
+            con.execute("CREATE INDEX IF NOT EXISTS time_watched_time "
+                        "ON time_watched (time)")
+        return
+    with con:
+        con.execute("ALTER TABLE time_watched RENAME TO time_watched_old")
+        _create_time_table(con.cursor())
+        con.execute(
+            "INSERT INTO time_watched SELECT username, MAX(time) "
+            "FROM time_watched_old GROUP BY username")
+        con.execute("DROP TABLE time_watched_old")
 
 
 @asyncio.coroutine
-def _get_url(loop, url):
-    session = aiohttp.ClientSession(loop=loop)
-    with aiohttp.Timeout(10):
-        response = yield from session.get(url)
-        try:
-            # other statements
-            return (yield from response.json())
-        finally:
-            if sys.exc_info()[0] is not None:
-                # on exceptions, close the connection altogether
-                response.close()
-            else:
-                yield from response.release()
-            session.close()
+def _get_url(http, url, cache=None, ttl=None, timeout=None,
+             revalidate=False):
+    """
+    GET a JSON url, through a :class:`MetadataCache` if given. Fresh cache
+    entries are returned without a request unless `revalidate` is set, in
+    which case the request is always made, conditional on the cached
+    ETag/Last-Modified.
+    """
+    entry = None
+    headers = {}
+    if cache is not None:
+        entry = yield from http.loop.run_in_executor(None, cache.get, url)
+        if entry is not None:
+            if not revalidate and cache.is_fresh(entry):
+                return entry['data']
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+    status, response_headers, data = yield from http.get(
+        url, headers, timeout)
+    if status == 304 and entry is not None:
+        yield from http.loop.run_in_executor(None, cache.touch, url)
+        return entry['data']
+    if cache is not None and 200 <= status < 300:
+        yield from http.loop.run_in_executor(
+            None, cache.put, url, data, ttl,
+            response_headers.get('ETag'),
+            response_headers.get('Last-Modified'))
+    return data
 
 
 def _decrease_msgcount(self):
@@ -95,12 +202,740 @@ def ratelimit_wrapper(coro):
 
         self.message_count += 1
         r = yield from coro(self, *args, **kwargs)
-        # make sure it doesn't block the event loop
-        self.loop.call_later(20, _decrease_msgcount, self)
+        # make sure it doesn't block the event loop, the window is counted
+        # by Twitch from when the message arrives
+        self.loop.call_later(20 + self.latency, _decrease_msgcount, self)
         return r
     return wrapper
 
 
+class JoinScheduler:
+    """
+    Batches and paces JOIN commands to stay within Twitch's join limits.
+
+    Channels are sent as comma-separated lists, as few lines as the IRC line
+    length allows, while the amount of join attempts per window is capped.
+
+    Parameters
+    ----------
+    write : callable
+        Called with each raw IRC line to send.
+    loop : :class:`asyncio.AbstractEventLoop`
+        The loop to run on.
+    rate : Optional[int]
+        The amount of channels that may be joined per window. (default: 20)
+    per : Optional[int]
+        The length of the window in seconds. (default: 10)
+    timeout : Optional[int]
+        Seconds to wait for a confirmation before retrying a join. (default: 30)
+    attempts : Optional[:class:`collections.deque`]
+        Join attempt timestamps, shared between schedulers of the same account.
+    max_tries : Optional[int]
+        Give up on a channel after this many unconfirmed joins. (default: 3)
+    on_failed : Optional[callable]
+        Called with a channel that was given up on.
+    """
+
+    max_line = 510  # 512 bytes including CRLF
+
+    # NOTICE msg-ids Twitch answers a JOIN with instead of joining
+    fatal_notices = frozenset((
+        "msg_channel_suspended", "msg_banned", "tos_ban",
+        "msg_room_not_found"))
+
+    def __init__(self, write, loop, rate=20, per=10, timeout=30,
+                 attempts=None, max_tries=3, on_failed=None):
+        self.write = write
+        self.loop = loop
+        self.rate = rate
+        self.per = per
+        self.timeout = timeout
+        self.max_tries = max_tries
+        self.on_failed = on_failed
+
+        self.pending = collections.OrderedDict()
+        self.sent = {}
+        self.confirmed = set()
+        self.failed = set()
+        self.tries = collections.Counter()
+
+        # Twitch limits joins per account, not per connection
+        self._attempts = (attempts if attempts is not None
+                          else collections.deque())
+        self._wakeup = asyncio.Event(loop=loop)
+        self._done = asyncio.Event(loop=loop)
+        self._done.set()
+        self._waiters = {}
+
+    def schedule(self, channels):
+        """ Queue channels to be joined, in order """
+        for c in channels:
+            if c in self.confirmed or c in self.sent:
+                continue
+            self.failed.discard(c)
+            self.tries.pop(c, None)
+            self.pending[c] = None
+        if self.pending:
+            self._done.clear()
+            self._wakeup.set()
+
+    def confirm(self, channel):
+        """ Mark a channel as joined, called on our own JOIN """
+        self.sent.pop(channel, None)
+        self.pending.pop(channel, None)
+        self.tries.pop(channel, None)
+        self.confirmed.add(channel)
+        for future in self._waiters.pop(channel, []):
+            if not future.done():
+                future.set_result(None)
+        if not self.pending and not self.sent:
+            self._done.set()
+
+    def fail(self, channel):
+        """ Give up on joining a channel, e.g. after a fatal NOTICE """
+        if channel in self.confirmed or channel in self.failed:
+            return
+        self.sent.pop(channel, None)
+        self.pending.pop(channel, None)
+        self.tries.pop(channel, None)
+        self.failed.add(channel)
+        for future in self._waiters.pop(channel, []):
+            if not future.done():
+                future.set_exception(
+                    Exception("Unable to join {}".format(channel)))
+        if not self.pending and not self.sent:
+            self._done.set()
+        if self.on_failed is not None:
+            self.on_failed(channel)
+
+    def reset(self, channels):
+        """
+        Forget the join state and queue `channels` again, except those
+        that were given up on.
+        """
+        self.pending.clear()
+        self.sent.clear()
+        self.confirmed.clear()
+        self.tries.clear()
+        self._done.set()
+        self.schedule(c for c in channels if c not in self.failed)
+
+    def forget(self, channel):
+        """ Stop tracking a channel, e.g. after leaving it """
+        self.sent.pop(channel, None)
+        self.pending.pop(channel, None)
+        self.confirmed.discard(channel)
+        self.failed.discard(channel)
+        self.tries.pop(channel, None)
+        for future in self._waiters.pop(channel, []):
+            future.cancel()
+        if not self.pending and not self.sent:
+            self._done.set()
+
+    @asyncio.coroutine
+    def wait_joined(self):
+        """ Wait until every scheduled channel is confirmed """
+        yield from self._done.wait()
+
+    @asyncio.coroutine
+    def wait_for(self, channel):
+        """ Wait until `channel` is confirmed """
+        if channel in self.confirmed:
+            return
+        future = asyncio.Future(loop=self.loop)
+        self._waiters.setdefault(channel, []).append(future)
+        yield from future
+
+    def _budget(self, now):
+        while self._attempts and now - self._attempts[0] >= self.per:
+            self._attempts.popleft()
+        return self.rate - len(self._attempts)
+
+    def _requeue_stale(self, now):
+        for c, sent_at in list(self.sent.items()):
+            if now - sent_at < self.timeout:
+                continue
+            if self.tries[c] >= self.max_tries:
+                self.fail(c)
+            else:
+                del self.sent[c]
+                self.pending[c] = None
+
+    def _build_lines(self, channels):
+        lines = []
+        current = []
+        length = len("JOIN ")
+        for c in channels:
+            extra = len(c) + (1 if current else 0)
+            if current and length + extra > self.max_line:
+                lines.append("JOIN " + ",".join(current))
+                current = []
+                length = len("JOIN ")
+                extra = len(c)
+            current.append(c)
+            length += extra
+        if current:
+            lines.append("JOIN " + ",".join(current))
+        return lines
+
+    @asyncio.coroutine
+    def run(self):
+        """ Send queued joins as fast as the limits permit """
+        while True:
+            now = self.loop.time()
+            self._requeue_stale(now)
+
+            if not self.pending:
+                self._wakeup.clear()
+                try:
+                    yield from asyncio.wait_for(
+                        self._wakeup.wait(), self.timeout, loop=self.loop)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            budget = self._budget(now)
+            if budget <= 0:
+                yield from asyncio.sleep(
+                    self.per - (now - self._attempts[0]), loop=self.loop)
+                continue
+
+            batch = []
+            while self.pending and len(batch) < budget:
+                c, _ = self.pending.popitem(last=False)
+                batch.append(c)
+                self.sent[c] = now
+                self.tries[c] += 1
+                self._attempts.append(now)
+
+            for line in self._build_lines(batch):
+                self.write(line)
+
+
+class RTTHistogram:
+    """
+    A rolling histogram of round-trip times.
+
+    Parameters
+    ----------
+    window : Optional[int]
+        The amount of recent samples to keep. (default: 100)
+    """
+
+    buckets = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, float("inf"))
+
+    def __init__(self, window=100):
+        self.samples = collections.deque(maxlen=window)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, rtt):
+        """ Record a round-trip time in seconds """
+        self.samples.append(rtt)
+
+    @property
+    def last(self):
+        return self.samples[-1] if self.samples else None
+
+    def mean(self):
+        if not self.samples:
+            return None
+        return sum(self.samples) / len(self.samples)
+
+    def percentile(self, p):
+        """ Returns the `p`th percentile (0-100) of recent samples """
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def histogram(self):
+        """ Returns a dict of bucket upper bound -> sample count """
+        counts = collections.OrderedDict((b, 0) for b in self.buckets)
+        for rtt in self.samples:
+            counts[self.buckets[bisect.bisect_left(self.buckets, rtt)]] += 1
+        return counts
+
+
+class HTTPPool:
+    """
+    One long-lived aiohttp session with a tuned connection pool, shared by
+    every HTTP request of a bot.
+
+    Parameters
+    ----------
+    loop : :class:`asyncio.AbstractEventLoop`
+        The loop to run on.
+    limit : Optional[int]
+        The maximum amount of open connections. (default: 100)
+    limit_per_host : Optional[int]
+        The maximum amount of open connections per host. (default: 10)
+    keepalive_timeout : Optional[int]
+        Seconds to keep idle connections open. (default: 30)
+    dns_ttl : Optional[int]
+        Seconds to cache DNS lookups. (default: 300)
+    timeout : Optional[int]
+        Default seconds before a request is aborted. (default: 10)
+    """
+
+    def __init__(self, loop, limit=100, limit_per_host=10,
+                 keepalive_timeout=30, dns_ttl=300, timeout=10):
+        self.loop = loop
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_ttl = dns_ttl
+        self.timeout = timeout
+
+        self.session = None
+        self.latency = RTTHistogram(window=200)
+        self.requests = 0
+        self.errors = 0
+
+    def _get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                loop=self.loop,
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                use_dns_cache=True,
+                ttl_dns_cache=self.dns_ttl)
+            self.session = aiohttp.ClientSession(
+                loop=self.loop, connector=connector)
+        return self.session
+
+    @asyncio.coroutine
+    def get(self, url, headers=None, timeout=None):
+        """
+        GET a url, returns a (status, headers, JSON body) tuple.
+
+        Raises for any status other than 2xx or 304, so error bodies are
+        never mistaken for data.
+        """
+        session = self._get_session()
+        start = self.loop.time()
+        self.requests += 1
+        try:
+            with aiohttp.Timeout(timeout or self.timeout):
+                response = yield from session.get(url, headers=headers or {})
+                try:
+                    if (response.status != 304 and
+                            not 200 <= response.status < 300):
+                        raise Exception("GET {} returned HTTP {}".format(
+                            url, response.status))
+                    if response.status == 304:
+                        data = None
+                    else:
+                        data = yield from response.json()
+                    return response.status, response.headers, data
+                finally:
+                    if sys.exc_info()[0] is not None:
+                        # on exceptions, close the connection altogether
+                        response.close()
+                    else:
+                        yield from response.release()
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.latency.add(self.loop.time() - start)
+
+    def stats(self):
+        """
+        Returns pool statistics: open and idle connections, request counts
+        and request latency in seconds.
+        """
+        connector = self.session and self.session.connector
+        idle = in_use = 0
+        if connector is not None:
+            pooled = getattr(connector, "_conns", {})
+            idle = sum(len(c) for c in pooled.values())
+            in_use = len(getattr(connector, "_acquired", ()))
+        return {
+            "open": idle + in_use,
+            "idle": idle,
+            "in_use": in_use,
+            "requests": self.requests,
+            "errors": self.errors,
+            "latency_mean": self.latency.mean(),
+            "latency_p99": self.latency.percentile(99)}
+
+    def close(self):
+        """ Close the session and all pooled connections """
+        if self.session is None:
+            return
+        result = self.session.close()
+        self.session = None
+        if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+            if self.loop.is_running():
+                asyncio.ensure_future(result, loop=self.loop)
+            else:
+                self.loop.run_until_complete(result)
+
+
+class ResponseCache:
+    """
+    An in-memory cache of JSON responses.
+
+    Concurrent requests for the same url share one fetch. Entries older than
+    their TTL are still answered right away for `stale` more seconds while
+    a refresh runs in the background.
+
+    Parameters
+    ----------
+    loop : :class:`asyncio.AbstractEventLoop`
+        The loop to run on.
+    maxlen : Optional[int]
+        The amount of responses to keep. (default: 1000)
+    """
+
+    def __init__(self, loop, maxlen=1000):
+        self.loop = loop
+        self.maxlen = maxlen
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._inflight = {}
+
+    @asyncio.coroutine
+    def get(self, url, fetch, ttl, stale=0):
+        """
+        Returns the response for a url.
+
+        Parameters
+        ----------
+        url : str
+            The cache key.
+        fetch : callable
+            Returns a coroutine fetching the url.
+        ttl : int
+            Seconds a response is fresh.
+        stale : Optional[int]
+            Seconds past `ttl` a response may be served while it is being
+            refreshed. (default: 0)
+        """
+        entry = self._entries.get(url)
+        if entry is not None:
+            fetched_at, data = entry
+            age = self.loop.time() - fetched_at
+            if age < ttl + stale:
+                self.hits += 1
+                self._entries.move_to_end(url)
+                if age >= ttl:
+                    self.refresh(url, fetch)
+                return data
+        self.misses += 1
+        return (yield from asyncio.shield(self.refresh(url, fetch),
+                                          loop=self.loop))
+
+    def refresh(self, url, fetch):
+        """
+        Start or join the fetch of a url, returns its future.
+
+        The future is shared, wrap it in :func:`asyncio.shield` before
+        waiting on it so a cancelled waiter doesn't cancel the others.
+        """
+        future = self._inflight.get(url)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(url, fetch),
+                                           loop=self.loop)
+            future.add_done_callback(
+                functools.partial(self._fetch_done, url))
+            self._inflight[url] = future
+        return future
+
+    def _fetch_done(self, url, future):
+        # runs even if the fetch was cancelled before it started
+        if self._inflight.get(url) is future:
+            del self._inflight[url]
+        # retrieve errors of background refreshes nobody waits for
+        future.cancelled() or future.exception()
+
+    @asyncio.coroutine
+    def _fetch(self, url, fetch):
+        data = yield from fetch()
+        self._entries[url] = (self.loop.time(), data)
+        self._entries.move_to_end(url)
+        if len(self._entries) > self.maxlen:
+            self._entries.popitem(last=False)
+        return data
+
+
+class SeenSet:
+    """
+    A bounded set of recently seen keys that expire after `window` seconds.
+
+    Parameters
+    ----------
+    window : Optional[int]
+        Seconds to remember a key. (default: 60)
+    maxlen : Optional[int]
+        The maximum amount of keys to remember. (default: 100000)
+    """
+
+    def __init__(self, window=60, maxlen=100000):
+        self.window = window
+        self.maxlen = maxlen
+        self._seen = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._seen
+
+    def __len__(self):
+        return len(self._seen)
+
+    def add(self, key, now=None):
+        """ Remember a key, returns False if it was already seen """
+        now = time.monotonic() if now is None else now
+        seen = self._seen
+        while seen:
+            oldest, at = next(iter(seen.items()))
+            if now - at < self.window and len(seen) < self.maxlen:
+                break
+            del seen[oldest]
+        if key in seen:
+            return False
+        seen[key] = now
+        return True
+
+
+class Connection:
+    """
+    A single IRC connection carrying a share of the bot's channels.
+
+    Lost connections, detected through EOF, socket errors or a RECONNECT
+    from Twitch, are reopened with jittered exponential backoff. Capabilities
+    and joined channels are restored. Lines sent in the meantime are buffered
+    until the connection is back, and chat lines until their own channel is
+    joined again.
+
+    While connected, a PING is sent every `Bot.ping_interval` seconds to
+    measure the round-trip time. A connection that doesn't answer within
+    `Bot.ping_timeout` seconds is considered dead and reconnected.
+
+    Parameters
+    ----------
+    bot : :class:`Bot`
+        The bot this connection belongs to.
+    index : int
+        The position of this connection in `Bot.connections`.
+    """
+
+    backoff_base = 1
+    backoff_max = 120
+    buffer_size = 200
+
+    def __init__(self, bot, index):
+        self.bot = bot
+        self.index = index
+        self.loop = bot.loop
+        # ordered, so channels are joined in the order they were added
+        self.channels = collections.OrderedDict()
+        self.reader = None
+        self.writer = None
+        self.ready = False
+        self.closed = False
+        self.join_scheduler = JoinScheduler(
+            self._send, self.loop, rate=bot.join_rate,
+            attempts=bot._join_attempts, on_failed=self._join_failed)
+        self.stats = {
+            "lines_in": 0,
+            "lines_out": 0,
+            "bytes_in": 0,
+            "bytes_out": 0,
+            "connected_at": None,
+            "reconnects": 0,
+            "reconnect_latency": None,
+            "buffered": 0}
+
+        # (channel or None, line)
+        self._buffer = collections.deque(maxlen=self.buffer_size)
+        self._attempt = 0
+        self._lost_at = None
+
+        self.rtt = RTTHistogram()
+        self._keepalive_task = None
+        self._ping_token = None
+        self._ping_sent = None
+        self._pong = asyncio.Event(loop=self.loop)
+
+    def _send(self, line):
+        """ Write a line now, dropped while disconnected """
+        if self.writer is None:
+            return
+        data = "{}\r\n".format(line).encode('utf-8')
+        self.writer.write(data)
+        self.stats["lines_out"] += 1
+        self.stats["bytes_out"] += len(data)
+
+    def _held(self, channel):
+        """ Whether lines for a channel have to wait for its join """
+        return (channel is not None and channel in self.channels and
+                channel not in self.join_scheduler.confirmed and
+                channel not in self.join_scheduler.failed)
+
+    def write(self, line, channel=None):
+        """
+        Send a raw IRC line, buffered while (re)connecting.
+
+        Lines for a `channel` carried by this connection are also held
+        until that channel is joined.
+        """
+        if not self.ready or self._held(channel):
+            self._buffer.append((channel, line))
+            self.stats["buffered"] = len(self._buffer)
+            return
+        self._send(line)
+
+    def _flush_buffer(self):
+        """ Send every buffered line that no longer has to wait """
+        if not self.ready:
+            return
+        held = collections.deque(maxlen=self.buffer_size)
+        while self._buffer:
+            channel, line = self._buffer.popleft()
+            if self._held(channel):
+                held.append((channel, line))
+            elif channel not in self.join_scheduler.failed:
+                self._send(line)
+        self._buffer = held
+        self.stats["buffered"] = len(held)
+
+    def confirm_join(self, channel):
+        """ Called on our own JOIN of a channel """
+        self.join_scheduler.confirm(channel)
+        self._flush_buffer()
+
+    def _join_failed(self, channel):
+        # drops the lines that were waiting for it
+        self._flush_buffer()
+
+    @asyncio.coroutine
+    def connect(self):
+        """ Open the socket, log in and restore the session """
+        self.reader, self.writer = yield from asyncio.open_connection(
+            self.bot.host, self.bot.port, loop=self.loop)
+        self.stats["connected_at"] = time.time()
+
+        if not self.bot.nick.startswith('justinfan'):
+            self._send("PASS {}".format(self.bot.oauth))
+        self._send("NICK {}".format(self.bot.nick))
+
+        for m in self.bot.capabilities:
+            self._send("CAP REQ :twitch.tv/{}".format(m))
+
+        self.ready = True
+        self.join_scheduler.reset(self.channels)
+        self._flush_buffer()
+        self._keepalive_task = self.loop.create_task(self._keepalive())
+
+    @asyncio.coroutine
+    def _keepalive(self):
+        while True:
+            yield from asyncio.sleep(self.bot.ping_interval, loop=self.loop)
+            self._ping_token = str(next(self.bot._ping_ids))
+            self._ping_sent = self.loop.time()
+            self._pong.clear()
+            self._send("PING :{}".format(self._ping_token))
+            try:
+                yield from asyncio.wait_for(
+                    self._pong.wait(), self.bot.ping_timeout, loop=self.loop)
+            except asyncio.TimeoutError:
+                self.reconnect()
+                return
+
+    def pong_received(self, token):
+        """ Called with the content of a PONG from the server """
+        if self._ping_sent is None or token != self._ping_token:
+            return
+        self.rtt.add(self.loop.time() - self._ping_sent)
+        self._ping_sent = None
+        self._pong.set()
+
+    def add_channel(self, channel):
+        self.channels[channel] = None
+        if self.writer is not None:
+            self.join_scheduler.schedule([channel])
+
+    def remove_channel(self, channel):
+        self.channels.pop(channel, None)
+        self.join_scheduler.forget(channel)
+
+    def reconnect(self):
+        """ Drop the socket, the read loop will open a new one """
+        if self.writer is not None:
+            self.writer.close()
+
+    def close(self):
+        self.closed = True
+        if self.writer is not None:
+            self.writer.close()
+
+    def _disconnected(self):
+        self.ready = False
+        self.reader = self.writer = None
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+        self._keepalive_task = None
+        self._ping_sent = None
+        if self._lost_at is None and self.stats["connected_at"] is not None:
+            self._lost_at = self.loop.time()
+
+    @asyncio.coroutine
+    def _backoff(self):
+        delay = min(self.backoff_max, self.backoff_base * 2 ** self._attempt)
+        self._attempt += 1
+        yield from asyncio.sleep(random.uniform(delay / 2, delay),
+                                 loop=self.loop)
+
+    @asyncio.coroutine
+    def _read_loop(self):
+        while True:
+            try:
+                raw = yield from self.reader.readline()
+            except (OSError, asyncio.IncompleteReadError):
+                return
+            if not raw:  # EOF
+                return
+
+            self.stats["lines_in"] += 1
+            self.stats["bytes_in"] += len(raw)
+            rdata = raw.decode("utf-8").strip()
+
+            if not rdata:
+                continue
+
+            yield from self.bot._handle_line(rdata, self)
+
+    @asyncio.coroutine
+    def run(self):
+        """ Receive lines and hand them to the bot, reconnecting if needed """
+        self.loop.create_task(self.join_scheduler.run())
+
+        while not self.closed:
+            try:
+                yield from self.connect()
+            except OSError:
+                self._disconnected()
+                yield from self._backoff()
+                continue
+
+            self._attempt = 0
+            if self._lost_at is not None:
+                self.stats["reconnects"] += 1
+                self.stats["reconnect_latency"] = (
+                    self.loop.time() - self._lost_at)
+                self._lost_at = None
+
+            yield from self._read_loop()
+            self._disconnected()
+
+            if not self.closed:
+                yield from self._backoff()
+
+
 class Bot:
     """
     A basic Bot. All others inherit from this.
@@ -118,13 +953,63 @@ class Bot:
     client_id : Optional[str]
         The application Client ID for the kraken API.
     cache : Optional[int]
-        The amount of messages to cache. (default: 100)
+        The amount of messages to cache per channel. (default: 100)
     admins : Optional[list]
         The usernames with full access to the bot.
     allow_streams : Optional[bool]
         Allow music to play continuous streams
+    join_rate : Optional[int]
+        The amount of channels to join per 10 seconds. (default: 20)
+    shards : Optional[int]
+        The amount of IRC connections to spread channels over. (default: 1)
+    channels_per_shard : Optional[int]
+        Open another connection once every connection carries this many
+        channels. (default: unlimited)
+    ping_interval : Optional[int]
+        Seconds between keepalive PINGs. (default: 60)
+    ping_timeout : Optional[int]
+        Seconds to wait for a PONG before reconnecting. (default: 10)
+    redundant_channels : Optional[list]
+        Channels to receive on several connections at once. Messages are
+        deduplicated by their id so events trigger once.
+    redundancy : Optional[int]
+        The amount of connections for each redundant channel. (default: 2)
+    dedup_window : Optional[int]
+        Seconds to remember message ids, so copies received on redundant
+        connections are dropped. (default: 60)
+    history : Optional[str]
+        A database file to store every message in, see `Bot.history`.
+    user_cache : Optional[int]
+        The amount of :class:`User` objects to reuse. (default: 10000)
+    cache_dir : Optional[str]
+        A directory to cache emotes and channel info in, so they're
+        available right away on the next start.
+    stats_concurrency : Optional[int]
+        The maximum amount of concurrent API requests while polling channel
+        stats. (default: 10)
+    stats_timeout : Optional[int]
+        Seconds before a single API request is aborted. (default: 10)
+    poll_min : Optional[int]
+        Seconds between stats polls of active channels. (default: 60)
+    poll_max : Optional[int]
+        The longest interval idle channels back off to. (default: 900)
+    poll_active_rate : Optional[float]
+        Chat messages per minute from which a channel counts as active.
+        Channels with only changing chatters keep their interval.
+        (default: 1)
+    balance_cache : Optional[int]
+        The amount of users to keep balances and watch time of in memory.
+        (default: 10000)
+    flush_interval : Optional[int]
+        Seconds between writes of changed balances and watch time.
+        (default: 5)
+    remote_storage : Optional[bool]
+        Don't open databases, storage calls go through `Bot.owner`. Set by
+        :class:`ShardedRunner` in its workers. (default: False)
     """
 
+    capabilities = ("commands", "tags", "membership")
+
     def __init__(self, **kwargs):
 
         if kwargs.get("config"):
@@ -163,12 +1048,42 @@ class Bot:
         # shouldn't, limit the message count to max-1
         self.message_count = 1
 
+        self.join_rate = kwargs.get("join_rate") or 20
+        self._join_attempts = collections.deque()
+
+        self.ping_interval = kwargs.get("ping_interval") or 60
+        self.ping_timeout = kwargs.get("ping_timeout") or 10
+        self._ping_ids = itertools.count()
+
+        self.channels_per_shard = kwargs.get("channels_per_shard")
+        self.connections = []
+        self._routes = {}
+        self._running = False
+
+        shards = kwargs.get("shards") or 1
+        if self.channels_per_shard:
+            shards = max(shards, math.ceil(
+                len(self.chan) / self.channels_per_shard))
+        for _ in range(shards):
+            self._add_connection()
+        for c in self.chan:
+            self._assign_channel(c)
+
+        self.redundancy = kwargs.get("redundancy") or 2
+        self._replicas = {}
+        self._seen = SeenSet(kwargs.get("dedup_window") or 60)
+        for c in kwargs.get("redundant_channels") or []:
+            self._add_replicas("#" + c.lower().strip("#"))
+
         self.regex = {
             "data": re.compile(
                 r"^(?:@(?P<tags>\S+)\s)?:(?P<data>\S+)(?:\s)"
                 r"(?P<action>[A-Z]+)(?:\s#)(?P<channel>\S+)"
                 r"(?:\s(?::)?(?P<content>.+))?"),
             "ping": re.compile("PING (?P<content>.+)"),
+            "reconnect": re.compile(r"^(?:@\S+\s)?:\S+ RECONNECT"),
+            "pong": re.compile(
+                r"^(?:@\S+\s)?:\S+ PONG \S+ :?(?P<content>.+)"),
             "author": re.compile(
                 "(?P<author>[a-zA-Z0-9_]+)!(?P=author)"
                 "@(?P=author).tmi.twitch.tv"),
@@ -177,29 +1092,227 @@ class Bot:
                 "(?P<channel>[a-zA-Z0-9_]+) "
                 "(?P<count>[0-9\-]+)")}
 
-        self.channel_stats = {}
-
-        self.viewer_count = {}
-        self.host_count = {}
-
-        self.viewers = {}
+        # Allocated on first use, see Bot._state
+        self.channel_states = {}
+        self.users = UserRegistry(kwargs.get("user_cache") or 10000)
+        self.emotes = EmoteCatalogue()
+
+        self.http = HTTPPool(self.loop) if aio_installed else None
+        self.responses = ResponseCache(self.loop)
+        self.stats_concurrency = kwargs.get("stats_concurrency") or 10
+        self.stats_timeout = kwargs.get("stats_timeout") or 10
+        self.poll_min = kwargs.get("poll_min") or 60
+        self.poll_max = kwargs.get("poll_max") or 900
+        self.poll_active_rate = kwargs.get("poll_active_rate") or 1
+
+        if kwargs.get("cache_dir"):
+            self.metadata_cache = MetadataCache(kwargs.get("cache_dir"))
+        else:
+            self.metadata_cache = None
 
-        self.hosts = {}
+        if kwargs.get("history"):
+            self.history_store = HistoryStore(kwargs.get("history"), self.loop)
+        else:
+            self.history_store = None
+
+        # SQLite databases by name, each running on its own thread
+        self.databases = {}
+        self.db = AsyncDatabaseMethods(self)
+        # set in ShardedRunner workers, storage is then run by the owner
+        self.owner = None
+        self.remote_storage = kwargs.get("remote_storage", False)
+        self.balance_cache = kwargs.get("balance_cache") or 10000
+        self.flush_interval = kwargs.get("flush_interval") or 5
+
+    def _open_database(self, name, path):
+        """ Open a database on its own thread, see `Bot.db` """
+        db = self.databases[name] = Database(path, self.loop, wal=True)
+        return db
+
+    def _open_cache(self, db, table, column):
+        """ Cache a balance column in memory, see `BalanceCache` """
+        return BalanceCache(db, table, column, self.balance_cache,
+                            self.flush_interval)
+
+    def _state(self, channel):
+        """ Returns the state of a channel, allocating it if needed """
+        channel = "#" + channel.lower().strip("#")
+        state = self.channel_states.get(channel)
+        if state is None:
+            state = self.channel_states[channel] = ChannelState(channel)
+        return state
+
+    # Read-only views kept for compatibility, use Bot.channel_states
+
+    @property
+    def channel_stats(self):
+        return {c: s.stats for c, s in self.channel_states.items()}
+
+    @property
+    def viewer_count(self):
+        return {c: s.viewer_count for c, s in self.channel_states.items()}
+
+    @property
+    def host_count(self):
+        return {c: s.host_count for c, s in self.channel_states.items()}
+
+    @property
+    def viewers(self):
+        return {c: s.viewers for c, s in self.channel_states.items()}
+
+    @property
+    def hosts(self):
+        return {c: s.hosts for c, s in self.channel_states.items()}
+
+    @property
+    def channel_moderators(self):
+        return {c: s.moderators for c, s in self.channel_states.items()}
+
+    @property
+    def messages(self):
+        return [m for s in self.channel_states.values() if s.messages
+                for m in s.messages]
+
+    def chatters(self, channel):
+        """ Returns the names of everyone currently in a channel's chat """
+        state = self.channel_states.get("#" + channel.lower().strip("#"))
+        if state is None:
+            return []
+        return list(state.roster)
+
+    def recent_messages(self, channel, author=None, limit=None):
+        """
+        Returns cached messages of a channel, oldest first.
 
-        self.messages = []
-        self.channel_moderators = {}
-            
-        for c in self.chan:
-            self.channel_stats[c] = {}
+        Parameters
+        ----------
+        channel : str
+            The channel to look in.
+        author : Optional[str]
+            Only return messages by this user.
+        limit : Optional[int]
+            The maximum amount of messages to return.
+        """
+        state = self.channel_states.get("#" + channel.lower().strip("#"))
+        if state is None or state.messages is None:
+            return []
+        if author is not None:
+            return state.messages.by_author(author, limit)
+        messages = list(state.messages)
+        return messages[-limit:] if limit else messages
 
-            self.viewer_count[c] = 0
-            self.host_count[c] = 0
+    def history(self, channel, author=None, since=None, limit=100):
+        """
+        Search the stored message history, requires the `history` option.
 
-            self.viewers[c] = {}
+        .. code-block:: python
 
-            self.hosts[c] = []
+            async for m in bot.history('channel', author='user', limit=20):
+                print(m.author, m.content)
 
-            self.channel_moderators[c] = []
+        Parameters
+        ----------
+        channel : str
+            The channel to search.
+        author : Optional[str]
+            Only return messages by this user.
+        since : Optional[datetime.datetime, float]
+            Only return messages sent after this time.
+        limit : Optional[int]
+            The maximum amount of messages to return. (default: 100)
+        """
+        if self.history_store is None:
+            raise Exception("Message history is disabled, "
+                            "pass history='file.db' to enable it")
+        return self.history_store.history(channel, author, since, limit)
+
+    @property
+    def reader(self):
+        return self.connections[0].reader
+
+    @property
+    def writer(self):
+        return self.connections[0].writer
+
+    def _add_connection(self):
+        conn = Connection(self, len(self.connections))
+        self.connections.append(conn)
+        if self._running:
+            self.loop.create_task(conn.run())
+        return conn
+
+    def _assign_channel(self, channel):
+        """ Route a channel to the least loaded connection """
+        if channel in self._routes:
+            return self._routes[channel]
+        conn = min(self.connections, key=lambda c: len(c.channels))
+        if (self.channels_per_shard
+                and len(conn.channels) >= self.channels_per_shard):
+            conn = self._add_connection()
+        conn.add_channel(channel)
+        self._routes[channel] = conn
+        return conn
+
+    def _add_replicas(self, channel):
+        """ Receive a channel on `Bot.redundancy` connections """
+        if channel not in self.chan:
+            self.chan.append(channel)
+        replicas = [self._assign_channel(channel)]
+        while len(replicas) < self.redundancy:
+            spare = [c for c in self.connections if c not in replicas]
+            if spare:
+                conn = min(spare, key=lambda c: len(c.channels))
+            else:
+                conn = self._add_connection()
+            conn.add_channel(channel)
+            replicas.append(conn)
+        self._replicas[channel] = replicas
+
+    def _primary(self, channel):
+        """ The first ready connection that joined a channel """
+        route = self._routes.get(channel) or self.connections[0]
+        replicas = self._replicas.get(channel, ())
+        for conn in replicas:
+            if conn.ready and channel in conn.join_scheduler.confirmed:
+                return conn
+        # still joining, but not refused
+        for conn in replicas:
+            if conn.ready and channel not in conn.join_scheduler.failed:
+                return conn
+        return route
+
+    def _connection_for(self, channel):
+        return self._primary("#" + channel.lower().strip("#"))
+
+    def _accept(self, action, channel, tags, conn):
+        """ Drop copies of events received on redundant connections """
+        if action in ("PRIVMSG", "USERNOTICE") and tags and "id" in tags:
+            return self._seen.add(tags["id"])
+        return conn is self._primary(channel)
+
+    def connection_stats(self):
+        """
+        Returns a list of statistics for every IRC connection.
+        """
+        return [dict(conn.stats,
+                     index=conn.index,
+                     channels=len(conn.channels),
+                     joined=len(conn.join_scheduler.confirmed),
+                     connected=conn.writer is not None,
+                     rtt=conn.rtt.last,
+                     rtt_mean=conn.rtt.mean(),
+                     rtt_p99=conn.rtt.percentile(99))
+                for conn in self.connections]
+
+    @property
+    def latency(self):
+        """
+        The mean round-trip time in seconds over all connections.
+        """
+        means = [c.rtt.mean() for c in self.connections if len(c.rtt)]
+        if not means:
+            return 0
+        return sum(means) / len(means)
 
     def debug(self):
         for x, y in self.__dict__.items():
@@ -219,7 +1332,8 @@ class Bot:
         config.read(path)
         self.oauth = config.get("Settings", "oauth", fallback=None)
         self.nick = config.get("Settings", "username", fallback=None)
-        self.chan = "#" + config.get("Settings", "channel", fallback="twitch")
+        self.chan = [
+            "#" + config.get("Settings", "channel", fallback="twitch")]
         self.prefix = config.get("Settings", "prefix", fallback="!")
         self.client_id = config.get("Settings", "client_id", fallback=None)
 
@@ -239,71 +1353,303 @@ class Bot:
                 "Accepted overrides start with 'event_' or 'raw_event'")
         setattr(self, coro.__name__, coro)
 
+    emotes_url = "https://twitchemotes.com/api_cache/v2/global.json"
+    channel_url = "https://api.twitch.tv/kraken/channels/{}?client_id={}"
+    hosts_url = "https://tmi.twitch.tv/hosts?target={}&include_logins=1"
+    chatters_url = "https://tmi.twitch.tv/group/user/{}/chatters"
+
+    # Seconds until cached responses should be refreshed
+    cache_ttls = {
+        "emotes": 86400,
+        "channel": 600,
+        "hosts": 300}
+
+    # Seconds (fresh, stale) responses are kept in memory
+    response_ttls = {
+        "emotes": (3600, 86400),
+        "channel": (60, 300),
+        "hosts": (60, 300),
+        "chatters": (30, 60)}
+
+    def _apply_channel(self, c, j):
+        self._state(c).stats = self._parse_channel(j)
+
+    def _parse_channel(self, j):
+        return {
+            'mature': j['mature'],
+            'title': j['status'],
+            'game': j['game'],
+            'id': j['_id'],
+            'created_at': time.mktime(
+                time.strptime(
+                    j['created_at'],
+                    '%Y-%m-%dT%H:%M:%SZ')),
+            'updated_at': time.mktime(
+                time.strptime(
+                    j['updated_at'],
+                    '%Y-%m-%dT%H:%M:%SZ')),
+            'delay': j['delay'],
+            'offline_logo': j['video_banner'],
+            'profile_picture': j['logo'],
+            'profile_banner': j['profile_banner'],
+            'twitch_partner': j['partner'],
+            'views': j['views'],
+            'followers': j['followers']}
+
+    def _apply_hosts(self, c, j):
+        state = self._state(c)
+        state.host_count = len(j['hosts'])
+        state.hosts = [x['host_login'] for x in j['hosts']]
+
+    def _apply_chatters(self, c, j):
+        state = self._state(c)
+        state.viewer_count = j['chatter_count']
+        return state.roster.update({
+            'viewers': j['chatters']['viewers'],
+            'moderators': j['chatters']['moderators'],
+            'staff': j['chatters']['staff'],
+            'admins': j['chatters']['admins'],
+            'global_moderators': j['chatters']['global_mods']})
+
+    @asyncio.coroutine
+    def _fetch(self, url, kind=None, timeout=None, fresh=False):
+        """
+        GET a JSON url. With a `kind`, responses are cached in memory and,
+        if enabled, on disk. `fresh` skips the memory cache and always asks
+        the API, revalidating the disk cache, but still shares a fetch that
+        is already running.
+        """
+        def fetch():
+            if kind in self.cache_ttls and self.metadata_cache is not None:
+                return _get_url(self.http, url, self.metadata_cache,
+                                self.cache_ttls[kind], timeout,
+                                revalidate=fresh)
+            return _get_url(self.http, url, timeout=timeout)
+
+        if kind is None:
+            return (yield from fetch())
+        if fresh:
+            return (yield from asyncio.shield(
+                self.responses.refresh(url, fetch), loop=self.loop))
+        ttl, stale = self.response_ttls[kind]
+        return (yield from self.responses.get(url, fetch, ttl, stale))
+
+    @asyncio.coroutine
+    def _poll(self, url, kind=None):
+        """ Like Bot._fetch, limited to `stats_concurrency` requests """
+        with (yield from self._stats_semaphore):
+            return (yield from self._fetch(url, kind, self.stats_timeout,
+                                           fresh=True))
+
+    @asyncio.coroutine
+    def fetch_json(self, url, ttl=60, stale=60):
+        """
+        GET a JSON url through the bot's response cache.
+
+        Parameters
+        ----------
+        url : str
+            The url to get.
+        ttl : Optional[int]
+            Seconds a response is reused. (default: 60)
+        stale : Optional[int]
+            Seconds past `ttl` an old response is returned right away
+            while it is refreshed. (default: 60)
+        """
+        fetch = functools.partial(_get_url, self.http, url)
+        return (yield from self.responses.get(url, fetch, ttl, stale))
+
+    @asyncio.coroutine
+    def fetch_channel_info(self, channel):
+        """
+        Returns up to date channel info, in the format of `Bot.channel_stats`.
+        Cached responses are returned right away and refreshed in the
+        background when old.
+
+        Parameters
+        ----------
+        channel : str
+            The channel to look up.
+        """
+        if not self.client_id:
+            raise Exception("A client_id is required to use the API")
+        c = "#" + channel.lower().strip("#")
+        j = yield from self._fetch(
+            self.channel_url.format(c[1:], self.client_id), "channel")
+        if c in self._routes:
+            self._apply_channel(c, j)
+            return self.channel_states[c].stats
+        return self._parse_channel(j)
+
+    @asyncio.coroutine
+    def _poll_channel(self, c):
+        """
+        Poll one channel, errors only affect this channel. Returns True if
+        the chatters changed.
+        """
+        state = self.channel_states.get(c)
+        channel_id = state.stats.get('id') if state else None
+
+        requests = [
+            self._poll(self.channel_url.format(c[1:], self.client_id),
+                       "channel"),
+            self._poll(self.chatters_url.format(c[1:]), "chatters")]
+        if channel_id is not None:
+            # the hosts lookup needs the id, which rarely changes
+            requests.append(self._poll(
+                self.hosts_url.format(channel_id), "hosts"))
+
+        results = yield from asyncio.gather(
+            *requests, loop=self.loop, return_exceptions=True)
+
+        if c not in self._routes:  # left while polling
+            return False
+
+        changed = False
+        appliers = [self._apply_channel, self._apply_chatters,
+                    self._apply_hosts]
+        for apply, j in zip(appliers, results):
+            if isinstance(j, Exception):
+                print("Failed to poll {}: {!r}".format(c, j))
+                continue
+            try:
+                diff = apply(c, j)
+                if diff:
+                    changed = True
+                    yield from self.event_roster_update(c, diff)
+            except Exception:
+                traceback.print_exc()
+
+        if channel_id is None and not isinstance(results[0], Exception):
+            try:
+                j = yield from self._poll(
+                    self.hosts_url.format(results[0]['_id']), "hosts")
+                self._apply_hosts(c, j)
+            except Exception as e:
+                print("Failed to poll {}: {!r}".format(c, e))
+
+        return changed
+
+    def _next_poll_interval(self, state, changed):
+        """
+        Poll channels with active chat often, back off exponentially on
+        idle ones. Chatter lists change on almost every poll of a channel
+        with an audience, so that alone only stops the back off.
+        """
+        elapsed = max(state.poll_interval, self.poll_min)
+        rate = state.activity * 60 / elapsed
+        if rate >= self.poll_active_rate:
+            interval = self.poll_min
+        elif changed or state.activity:
+            interval = max(self.poll_min, state.poll_interval)
+        else:
+            interval = min(self.poll_max,
+                           max(self.poll_min, state.poll_interval * 2))
+        state.activity = 0
+        state.poll_interval = interval
+        return interval
+
+    @asyncio.coroutine
+    def _poll_scheduled(self, c):
+        try:
+            changed = yield from self._poll_channel(c)
+        except Exception:
+            traceback.print_exc()
+            changed = False
+        if c not in self._routes:
+            self._poll_scheduled_set.discard(c)
+            return
+        interval = self._next_poll_interval(self._state(c), changed)
+        heapq.heappush(self._poll_heap, (self.loop.time() + interval, c))
+        self._poll_wakeup.set()
+
+    @asyncio.coroutine
+    def _refresh_emotes(self):
+        try:
+            j = yield from self._fetch(self.emotes_url, "emotes")
+            self.emotes.refresh(j['emotes'])
+        except Exception:
+            traceback.print_exc()
+
+    @asyncio.coroutine
+    def _load_cached_stats(self):
+        """ Use cached data right away, returns True if emotes were cached """
+        cache = self.metadata_cache
+        if cache is None:
+            return False
+
+        def cached(url):
+            entry = cache.get(url)
+            return entry and entry['data']
+
+        j = yield from self.loop.run_in_executor(
+            None, cached, self.emotes_url)
+        if j:
+            self.emotes.refresh(j['emotes'])
+        has_emotes = bool(j)
+
+        if not self.client_id:
+            return has_emotes
+
+        for c in list(self.chan):
+            try:
+                j = yield from self.loop.run_in_executor(
+                    None, cached,
+                    self.channel_url.format(c[1:], self.client_id))
+                if not j:
+                    continue
+                self._apply_channel(c, j)
+                j = yield from self.loop.run_in_executor(
+                    None, cached, self.hosts_url.format(j['_id']))
+                if j:
+                    self._apply_hosts(c, j)
+            except Exception:
+                # a bad entry only costs this channel its head start
+                traceback.print_exc()
+        return has_emotes
+
     @asyncio.coroutine
     def _get_stats(self):
         """ Gets JSON from the Kraken API """
         if not aio_installed:
             return
 
-        global emotes
-        emotes = (yield from _get_url(
-            self.loop,
-            "https://twitchemotes.com/api_cache/v2/global.json"))['emotes']
+        if (yield from self._load_cached_stats()):
+            self.loop.create_task(self._refresh_emotes())
+        else:
+            yield from self._refresh_emotes()
 
         if not self.client_id:
             return
 
+        self._stats_semaphore = asyncio.Semaphore(
+            self.stats_concurrency, loop=self.loop)
+
+        self._poll_heap = []
+        self._poll_scheduled_set = set()
+        self._poll_wakeup = asyncio.Event(loop=self.loop)
+
         while True:
+            now = self.loop.time()
+            for c in self._routes.keys() - self._poll_scheduled_set:
+                self._poll_scheduled_set.add(c)
+                heapq.heappush(self._poll_heap, (now, c))
+
+            while self._poll_heap and self._poll_heap[0][0] <= now:
+                _, c = heapq.heappop(self._poll_heap)
+                if c not in self._routes:
+                    self._poll_scheduled_set.discard(c)
+                    continue
+                self.loop.create_task(self._poll_scheduled(c))
+
+            delay = self._poll_heap[0][0] - now if self._poll_heap else 5
+            self._poll_wakeup.clear()
             try:
-                for c in self.chan:
-                    j = yield from _get_url(
-                        self.loop,
-                        'https://api.twitch.tv/kraken/channels/{}?client_id={}'
-                        .format(c[1:], self.client_id))
-                    self.channel_stats[c] = {
-                        'mature': j['mature'],
-                        'title': j['status'],
-                        'game': j['game'],
-                        'id': j['_id'],
-                        'created_at': time.mktime(
-                            time.strptime(
-                                j['created_at'],
-                                '%Y-%m-%dT%H:%M:%SZ')),
-                        'updated_at': time.mktime(
-                            time.strptime(
-                                j['updated_at'],
-                                '%Y-%m-%dT%H:%M:%SZ')),
-                        'delay': j['delay'],
-                        'offline_logo': j['video_banner'],
-                        'profile_picture': j['logo'],
-                        'profile_banner': j['profile_banner'],
-                        'twitch_partner': j['partner'],
-                        'views': j['views'],
-                        'followers': j['followers']}
-
-                    j = yield from _get_url(
-                        self.loop,
-                        'https://tmi.twitch.tv/hosts?target={}&include_logins=1'
-                        .format(j['_id']))
-                    self.host_count[c] = len(j['hosts'])
-                    self.hosts[c] = [x['host_login'] for x in j['hosts']]
-
-                    j = yield from _get_url(
-                        self.loop,
-                        'https://tmi.twitch.tv/group/user/{}/chatters'
-                        .format(c[1:]))
-                    self.viewer_count[c] = j['chatter_count']
-                    self.channel_moderators[c] = j['chatters']['moderators']
-                    self.viewers[c]['viewers'] = j['chatters']['viewers']
-                    self.viewers[c]['moderators'] = j['chatters']['moderators']
-                    self.viewers[c]['staff'] = j['chatters']['staff']
-                    self.viewers[c]['admins'] = j['chatters']['admins']
-                    self.viewers[c]['global_moderators'] = j[
-                        'chatters']['global_mods']
-
-            except Exception:
-                traceback.print_exc()
-            yield from asyncio.sleep(60)
+                # wake up at least every 5 seconds to pick up new channels
+                yield from asyncio.wait_for(
+                    self._poll_wakeup.wait(), min(delay, 5), loop=self.loop)
+            except asyncio.TimeoutError:
+                pass
 
     def start(self, tasked=False):
         """
@@ -323,9 +1669,10 @@ class Bot:
             self.loop.run_until_complete(self._tcp_echo_client())
 
     @asyncio.coroutine
-    def _pong(self, src):
+    def _pong(self, src, conn):
         """ Tell remote we're still alive """
-        self.writer.write("PONG {}\r\n".format(src).encode('utf-8'))
+        # a protocol reply, never held back by the join buffer
+        conn._send("PONG {}".format(src))
 
     @asyncio.coroutine
     @ratelimit_wrapper
@@ -353,43 +1700,74 @@ class Bot:
         yield from self._send_privmsg(channel, message)
 
     @asyncio.coroutine
-    def _nick(self):
-        """ Send name """
-        self.writer.write("NICK {}\r\n".format(self.nick).encode('utf-8'))
+    def join_channel(self, channel, wait=True):
+        """
+        Join a channel while the bot is running.
+
+        Parameters
+        ----------
+        channel : str
+            The channel to join.
+        wait : Optional[bool]
+            Wait until Twitch confirms the join. (default: True)
+        """
+        channel = "#" + channel.lower().strip("#")
+        if channel not in self.chan:
+            self.chan.append(channel)
+        conn = yield from self._join(channel)
+        if wait and self._running:
+            yield from conn.join_scheduler.wait_for(channel)
 
     @asyncio.coroutine
-    def _pass(self):
-        """ Send oauth token """
-        self.writer.write("PASS {}\r\n".format(self.oauth).encode('utf-8'))
+    def part_channel(self, channel):
+        """
+        Leave a channel and release its state.
+
+        Parameters
+        ----------
+        channel : str
+            The channel to leave.
+        """
+        channel = "#" + channel.lower().strip("#")
+        if channel in self.chan:
+            self.chan.remove(channel)
+        yield from self._part(channel)
+        self.channel_states.pop(channel, None)
+        self.users.forget_channel(channel)
 
     @asyncio.coroutine
     def _join(self, channel):
         """ Join a channel """
-        self.writer.write("JOIN {}\r\n".format(channel).encode('utf-8'))
+        return self._assign_channel("#" + channel.lower().strip("#"))
 
     @asyncio.coroutine
     def _part(self, channel):
         """ Leave a channel """
-        self.writer.write("PART #{}\r\n".format(channel).encode('utf-8'))
-
-    @asyncio.coroutine
-    def _special(self, mode):
-        """ Allows for more events """
-        self.writer.write(
-            bytes("CAP REQ :twitch.tv/{}\r\n".format(mode), "UTF-8"))
+        channel = "#" + channel.lower().strip("#")
+        conn = self._routes.pop(channel, None)
+        for conn in self._replicas.pop(channel, [conn]):
+            if conn is not None:
+                conn.remove_channel(channel)
+                conn.write("PART {}".format(channel))
 
     @asyncio.coroutine
     def _cache(self, message):
-        self.messages.append(message)
-        if len(self.messages) > self.cache_length:
-            self.messages.pop(0)
+        if message.channel is None:
+            return
+        state = self._state(message.channel)
+        if state.messages is None:
+            state.messages = MessageCache(self.cache_length)
+        state.messages.append(message)
+        if self.history_store is not None:
+            self.history_store.append(message)
 
     @asyncio.coroutine
     def _send_privmsg(self, channel, s):
         """ DO NOT USE THIS YOURSELF OR YOU RISK GETTING BANNED FROM TWITCH """
         s = s.replace("\n", " ")
-        self.writer.write("PRIVMSG #{} :{}\r\n".format(
-            channel, s).encode('utf-8'))
+        channel = "#" + channel.lower().strip("#")
+        self._primary(channel).write(
+            "PRIVMSG {} :{}".format(channel, s), channel)
 
     # The following are Twitch commands, such as /me, /ban and /host, so I'm
     # not going to put docstrings on these
@@ -669,180 +2047,201 @@ class Bot:
 
     @asyncio.coroutine
     def _tcp_echo_client(self):
-        """ Receive events and trigger events """
+        """ Run every connection, merging their events """
+        self._running = True
+        yield from asyncio.gather(
+            *[conn.run() for conn in self.connections], loop=self.loop)
 
-        self.reader, self.writer = yield from asyncio.open_connection(
-            self.host, self.port, loop=self.loop)
+    @asyncio.coroutine
+    def _handle_line(self, rdata, conn):
+        """ Parse a line received on `conn` and trigger events """
+        yield from self.raw_event(rdata)
 
-        if not self.nick.startswith('justinfan'):
-            yield from self._pass()
-        yield from self._nick()
+        if self.regex["reconnect"].match(rdata):
+            conn.reconnect()
+            return
 
-        modes = ("commands", "tags", "membership")
-        for m in modes:
-            yield from self._special(m)
+        pong = self.regex["pong"].match(rdata)
+        if pong:
+            conn.pong_received(pong.group("content"))
+            return
 
-        for c in self.chan:
-            yield from self._join(c)
+        try:
 
-        while True:
-            rdata = (yield from self.reader.readline()).decode("utf-8").strip()
+            if rdata.startswith("PING"):
+                p = self.regex["ping"]
 
-            if not rdata:
-                continue
+            else:
+                p = self.regex["data"]
 
-            yield from self.raw_event(rdata)
+            m = p.match(rdata)
 
             try:
+                tags = m.group("tags")
+
+                tagdict = {}
+                for tag in tags.split(";"):
+                    t = tag.split("=")
+                    if t[1].isnumeric():
+                        t[1] = int(t[1])
+                    tagdict[t[0]] = t[1]
+                tags = tagdict
+            except:
+                tags = None
 
-                if rdata.startswith("PING"):
-                    p = self.regex["ping"]
+            try:
+                action = m.group("action")
+            except:
+                action = "PING"
 
-                else:
-                    p = self.regex["data"]
+            try:
+                data = m.group("data")
+            except:
+                data = None
 
-                m = p.match(rdata)
+            try:
+                content = m.group('content')
+            except:
+                content = None
 
-                try:
-                    tags = m.group("tags")
-
-                    tagdict = {}
-                    for tag in tags.split(";"):
-                        t = tag.split("=")
-                        if t[1].isnumeric():
-                            t[1] = int(t[1])
-                        tagdict[t[0]] = t[1]
-                    tags = tagdict
-                except:
-                    tags = None
+            try:
+                channel = m.group('channel')
+            except:
+                channel = None
 
-                try:
-                    action = m.group("action")
-                except:
-                    action = "PING"
+        except:
+            pass
 
-                try:
-                    data = m.group("data")
-                except:
-                    data = None
+        else:
+            try:
+                if not action:
+                    return
 
-                try:
-                    content = m.group('content')
-                except:
-                    content = None
+                if (channel and action == "NOTICE" and tags and
+                        tags.get("msg-id") in JoinScheduler.fatal_notices and
+                        "#" + channel in conn.channels):
+                    # Twitch refused the join, stop retrying it
+                    conn.join_scheduler.fail("#" + channel)
 
-                try:
-                    channel = m.group('channel')
-                except:
-                    channel = None
+                if channel and "#" + channel in self._replicas:
+                    if action == "JOIN" and data.startswith(self.nick + "!"):
+                        conn.confirm_join("#" + channel)
+                    if not self._accept(action, "#" + channel, tags, conn):
+                        return
 
-            except:
-                pass
+                if action == "PING":
+                    yield from self._pong(content, conn)
 
-            else:
-                try:
-                    if not action:
-                        continue
+                elif action == "PRIVMSG":
+                    sender = self.regex["author"].match(
+                        data).group("author")
 
-                    if action == "PING":
-                        yield from self._pong(content)
+                    self._state(channel).activity += 1
 
-                    elif action == "PRIVMSG":
-                        sender = self.regex["author"].match(
-                            data).group("author")
+                    messageobj = Message(
+                        content, sender, channel, tags,
+                        self.users.get(sender, channel, tags), self.emotes)
 
-                        messageobj = Message(content, sender, channel, tags)
+                    yield from self._cache(messageobj)
 
-                        yield from self._cache(messageobj)
+                    yield from self.event_message(messageobj)
 
-                        yield from self.event_message(messageobj)
+                elif action == "WHISPER":
+                    sender = self.regex["author"].match(
+                        data).group("author")
 
-                    elif action == "WHISPER":
-                        sender = self.regex["author"].match(
-                            data).group("author")
+                    messageobj = Message(
+                        content, sender, channel, tags,
+                        self.users.get(sender, channel, tags), self.emotes)
 
-                        messageobj = Message(content, sender, channel, tags)
+                    yield from self._cache(messageobj)
 
-                        yield from self._cache(messageobj)
+                    yield from self.event_private_message(messageobj)
 
-                        yield from self.event_private_message(messageobj)
+                elif action == "JOIN":
+                    sender = self.regex["author"].match(
+                        data).group("author")
 
-                    elif action == "JOIN":
-                        sender = self.regex["author"].match(
-                            data).group("author")
+                    if sender == self.nick:
+                        conn.confirm_join("#" + channel)
 
-                        yield from self.event_user_join(User(sender, channel))
+                    yield from self.event_user_join(self.users.get(sender, channel))
 
-                    elif action == "PART":
-                        sender = self.regex["author"].match(
-                            data).group("author")
+                elif action == "PART":
+                    sender = self.regex["author"].match(
+                        data).group("author")
 
-                        yield from self.event_user_leave(User(sender, channel))
+                    yield from self.event_user_leave(self.users.get(sender, channel))
 
-                    elif action == "MODE":
+                elif action == "MODE":
 
-                        m = self.regex["mode"].match(content)
-                        mode = m.group("mode")
-                        user = m.group("user")
+                    m = self.regex["mode"].match(content)
+                    mode = m.group("mode")
+                    user = m.group("user")
 
-                        if mode == "+":
-                            yield from self.event_user_op(User(user, channel))
-                        else:
-                            yield from self.event_user_deop(User(user, channel))
+                    user = self.users.get(user, channel)
+                    if mode == "+":
+                        user.mod = 1
+                        yield from self.event_user_op(user)
+                    else:
+                        user.mod = 0
+                        yield from self.event_user_deop(user)
 
-                    elif action == "USERSTATE":
+                elif action == "USERSTATE":
 
-                        if tags["mod"] == 1:
-                            self.is_mod = True
-                        else:
-                            self.is_mod = False
+                    if tags["mod"] == 1:
+                        self.is_mod = True
+                    else:
+                        self.is_mod = False
 
-                        yield from self.event_userstate(User(self.nick, channel, tags))
+                    yield from self.event_userstate(self.users.get(self.nick, channel, tags))
 
-                    elif action == "ROOMSTATE":
-                        yield from self.event_roomstate(channel, tags)
+                elif action == "ROOMSTATE":
+                    yield from self.event_roomstate(channel, tags)
 
-                    elif action == "NOTICE":
-                        yield from self.event_notice(channel, tags)
+                elif action == "NOTICE":
+                    yield from self.event_notice(channel, tags)
 
-                    elif action == "CLEARCHAT":
-                        if not content:
-                            yield from self.event_clear(channel)
-                        else:
-                            if "ban-duration" in tags.keys():
-                                yield from self.event_timeout(
-                                    User(content, channel), tags)
-                            else:
-                                yield from self.event_ban(
-                                    User(content, channel), tags)
-
-                    elif action == "HOSTTARGET":
-                        m = self.regex["host"].match(content)
-                        hchannel = m.group("channel")
-                        viewers = m.group("count")
-
-                        if channel == "-":
-                            yield from self.event_host_stop(channel, viewers)
+                elif action == "CLEARCHAT":
+                    if not content:
+                        yield from self.event_clear(channel)
+                    else:
+                        if "ban-duration" in tags.keys():
+                            yield from self.event_timeout(
+                                self.users.get(content, channel), tags)
                         else:
-                            yield from self.event_host_start(channel, hchannel, viewers)
+                            yield from self.event_ban(
+                                self.users.get(content, channel), tags)
 
-                    elif action == "USERNOTICE":
-                        message = content or ""
-                        user = tags["login"]
+                elif action == "HOSTTARGET":
+                    m = self.regex["host"].match(content)
+                    hchannel = m.group("channel")
+                    viewers = m.group("count")
 
-                        yield from self.event_subscribe(
-                            Message(message, user, channel, tags), tags)
+                    if channel == "-":
+                        yield from self.event_host_stop(channel, viewers)
+                    else:
+                        yield from self.event_host_start(channel, hchannel, viewers)
 
-                    elif action == "CAP":
-                        # We don"t need this for anything, so just ignore it
-                        continue
+                elif action == "USERNOTICE":
+                    message = content or ""
+                    user = tags["login"]
 
-                    else:
-                        print("Unknown event:", action)
-                        print(rdata)
+                    yield from self.event_subscribe(
+                        Message(message, user, channel, tags,
+                                self.users.get(user, channel, tags),
+                                self.emotes), tags)
+
+                elif action == "CAP":
+                    # We don"t need this for anything, so just ignore it
+                    return
+
+                else:
+                    print("Unknown event:", action)
+                    print(rdata)
 
-                except Exception as e:
-                    yield from self.parse_error(e)
+            except Exception as e:
+                yield from self.parse_error(e)
 
     # Events called by TCP connection
 
@@ -958,6 +2357,14 @@ class Bot:
         """
         pass
 
+    @asyncio.coroutine
+    def event_roster_update(self, channel, diff):
+        """
+        Called when polling finds chatters that joined, left or changed role.
+        `diff` is a :class:`RosterDiff`.
+        """
+        pass
+
     # End of events
 
     def stop(self, exit=False):
@@ -973,8 +2380,14 @@ class Bot:
         if hasattr(self, "player"):
             self.player.terminate()
 
-        if hasattr(self, "writer"):
-            self.writer.close()
+        for conn in self.connections:
+            conn.close()
+
+        if self.history_store is not None:
+            self.history_store.close()
+
+        if self.http is not None:
+            self.http.close()
 
         pending = asyncio.Task.all_tasks()
         gathered = asyncio.gather(*pending)
@@ -986,6 +2399,9 @@ class Bot:
         except:  # Can be ignored
             pass
 
+        for db in self.databases.values():
+            db.close()
+
         if exit:
             self.loop.stop()
             sys.exit(0)
@@ -1166,50 +2582,162 @@ class CurrencyBot(Bot):
         super().__init__(*args, **kwargs)
         self.currency_name = currency
         self.currency_database_name = points_database
+        if self.remote_storage:
+            self.currency_db = None
+            return
         if not pathlib.Path(points_database).is_file():
             _setup_points_db(points_database)
-        self.currency_database = sqlite3.connect(points_database)
-        self.currency_cursor = self.currency_database.cursor()
-
+        self.currency_db = self._open_database("currency", points_database)
+        self.currency_database = self.currency_db.connection
+        self.currency_db.run_sync(_migrate_points_db, self.currency_database)
+        self.currency_cursor = self.currency_db.run_sync(
+            self.currency_database.cursor)
+        self.currency_cache = self._open_cache(
+            self.currency_db, "currency", "balance")
+
+    @db_method("currency_db")
     def check_user_currency(self, user):
         """ Check if the user is already in the database """
-        return bool(list(self.currency_cursor.execute(
-            "SELECT * FROM currency WHERE username = ?", (user,))))
+        return user in self.currency_cache
 
+    @db_method("currency_db")
     def add_user_currency(self, user):
-        self.currency_cursor.execute(
-            "INSERT INTO currency VALUES (?,0)", (user,))
+        self.currency_cache.add(user, 0)
+
+    @db_method("currency_db")
+    def _change_currency(self, user, amount):
+        self.currency_cache.add(user, amount)
 
+    @db_method("currency_db")
     def add_currency(self, user, amount):
-        balance = self.get_currency(user)[0]
-        self.currency_cursor.execute(
-            "UPDATE currency SET balance = ? WHERE username = ?",
-            (balance + amount, user))
+        """ Add currency to a user, adding the user if needed """
+        self._change_currency(user, amount)
 
+    @db_method("currency_db")
     def remove_currency(self, user, amount, force_remove=False):
-        balance = self.get_currency(user)[0]
-        if amount > balance and not force_remove:
-            raise Exception(
-                "{} owns {} {0.currency_name}, unable to remove {}."
-                "Use force_remove=True to force this action.".format(
-                    user, balance, self, amount))
-        self.currency_cursor.execute(
-            "UPDATE currency SET balance = ? WHERE username = ?",
-            (balance - amount, user))
+        if not force_remove:
+            balance = self.currency_cache.get(user) or 0
+            if balance < amount:
+                raise Exception(
+                    "{} owns {} {}, unable to remove {}. "
+                    "Use force_remove=True to force this action.".format(
+                        user, balance, self.currency_name, amount))
+        self.currency_cache.add(user, -amount)
 
+    @db_method("currency_db")
+    def add_currency_many(self, users, amount):
+        """
+        Add currency to many users in one transaction, adding users if
+        needed. Returns once the change is committed.
+
+        .. code-block:: python
+
+            bot.add_currency_many(bot.chatters('channel'), 100)
+
+        Parameters
+        ----------
+        users : iterable
+            The usernames to add to.
+        amount : int
+            The amount to add to each user, use `remove_currency` to take
+            currency away.
+        """
+        if amount < 0:
+            raise Exception("Unable to add a negative amount of {}.".format(
+                self.currency_name))
+        self.currency_cache.add_now((user, amount) for user in set(users))
+
+    @db_method("currency_db")
+    def set_currency_many(self, users, amount=None):
+        """
+        Set the balance of many users in one transaction, adding users if
+        needed. Returns once the change is committed.
+
+        Parameters
+        ----------
+        users : dict, iterable
+            A username -> balance dict, or the usernames to set to `amount`.
+        amount : Optional[int]
+            The balance to give every user, if `users` is not a dict.
+        """
+        if amount is None:
+            rows = users.items()
+        else:
+            rows = ((user, amount) for user in set(users))
+        self.currency_cache.set_now(rows)
+
+    @db_method("currency_db")
+    def transfer(self, user, to, amount, force_remove=False):
+        """
+        Move currency from one user to one or more users in one
+        transaction. Returns once the change is committed.
+
+        Parameters
+        ----------
+        user : str
+            The user to take currency from.
+        to : str, iterable
+            The user or usernames to give `amount` to.
+        amount : int
+            The amount every receiver gets, can't be negative.
+        force_remove : Optional[bool]
+            Allow the sender's balance to go negative. (default: False)
+        """
+        if amount < 0:
+            raise Exception(
+                "Unable to transfer a negative amount of {}.".format(
+                    self.currency_name))
+        receivers = [to] if isinstance(to, str) else list(set(to))
+        total = amount * len(receivers)
+        if not force_remove:
+            balance = self.currency_cache.get(user) or 0
+            if balance < total:
+                raise Exception(
+                    "{} owns {} {}, unable to transfer {}. "
+                    "Use force_remove=True to force this action.".format(
+                        user, balance, self.currency_name, total))
+        rows = collections.Counter({user: -total})
+        for receiver in receivers:
+            rows[receiver] += amount
+        self.currency_cache.add_now(rows.items())
+
+    @db_method("currency_db")
     def get_currency(self, user):
-        entry = list(self.currency_cursor.execute(
-            "SELECT balance FROM currency WHERE username = ?", (user,)))
-        return entry[0]
+        balance = self.currency_cache.get(user)
+        if balance is None:
+            raise IndexError("{} is not in the database".format(user))
+        return (balance,)
+
+    @db_method("currency_db")
+    def top_currency(self, n=10):
+        """ Returns the (username, balance) of the `n` richest users """
+        return self.currency_cache.top(n)
+
+    @db_method("currency_db")
+    def currency_rank_of(self, user):
+        """
+        Returns the leaderboard position of a user, or None. See
+        `BalanceCache.rank_of` for the cost outside of the top.
+        """
+        return self.currency_cache.rank_of(user)
 
+    @db_method("currency_db")
     def save_currency_database(self):
+        """ Write all changes now, they're written periodically anyway """
+        self.currency_cache.flush()
         self.currency_database.commit()
 
+    @db_method("currency_db")
     def reset_currency_database(self):
-        self.currency_cursor.execute("DROP TABLE currency")
-        _setup_points_db(self.currency_database_name)
+        self.currency_cache.clear()
+        with self.currency_database:
+            self.currency_cursor.execute("DROP TABLE currency")
+            _create_currency_table(self.currency_cursor)
 
+    @db_method("currency_db")
     def undo_currency_database_changes(self):
+        """ Forget changes that weren't written yet """
+        self.currency_cache.discard()
         self.currency_database.rollback()
 
 
@@ -1221,67 +2749,97 @@ class ViewTimeBot(Bot):
         if not aio_installed:
             raise Exception("ViewTimeBot requires aiohttp to be installed!")
         self.time_database_name = time_database
+        self.loop.create_task(self.collect_task())
+        if self.remote_storage:
+            self.time_db = None
+            return
         if not pathlib.Path(time_database).is_file():
             _setup_time_db(time_database)
-        self.time_database = sqlite3.connect(time_database)
-        self.time_cursor = self.time_database.cursor()
-        self.loop.create_task(self.collect_task())
+        self.time_db = self._open_database("time", time_database)
+        self.time_database = self.time_db.connection
+        self.time_db.run_sync(_migrate_time_db, self.time_database)
+        self.time_cursor = self.time_db.run_sync(self.time_database.cursor)
+        self.time_cache = self._open_cache(
+            self.time_db, "time_watched", "time")
 
     @asyncio.coroutine
     def collect_task(self):
         yield from asyncio.sleep(10)
         while True:
             yield from asyncio.sleep(60)
-            users = []
-            for group in self.viewers.values():
-                for viewer in group:
-                    if not self.check_user_time(viewer):
-                        self.add_user_time(viewer)
-                    self.add_time(viewer, 60)
-                    users.append(viewer)
-            self.save_time_database()
+            users = set()
+            for state in self.channel_states.values():
+                users.update(state.roster)
+            users = list(users)
+            yield from self.db._accrue(users, 60)
             yield from self.event_viewtime_update(users)
 
+    @db_method("time_db")
+    def _accrue(self, users, seconds):
+        """ Add watch time to every user """
+        self.time_cache.add_many((user, seconds) for user in users)
+
     @asyncio.coroutine
     def event_viewtime_update(self, users):
         pass
 
+    @db_method("time_db")
     def check_user_time(self, user):
         """ Check if the user is already in the database """
-        return bool(list(self.time_cursor.execute(
-            "SELECT * FROM time_watched WHERE username = ?", (user,))))
+        return user in self.time_cache
 
+    @db_method("time_db")
     def add_user_time(self, user):
-        self.time_cursor.execute(
-            "INSERT INTO time_watched VALUES (?,0)", (user,))
+        self.time_cache.add(user, 0)
 
+    @db_method("time_db")
     def add_time(self, user, amount):
-        time = self.get_time(user)[0]
-        self.time_cursor.execute(
-            "UPDATE time_watched SET time = ? WHERE username = ?",
-            (time + amount, user))
+        """ Add watch time to a user, adding the user if needed """
+        self.time_cache.add(user, amount)
 
+    @db_method("time_db")
     def remove_time(self, user, amount, force_remove=False):
-        time = self.get_time(user)
-        if amount > time:
-            amount = time
-        self.time_cursor.execute(
-            "UPDATE time_watched SET time = ? WHERE username = ?",
-            (time - amount, user))
+        time = self.time_cache.get(user)
+        if time is not None:
+            self.time_cache.add(user, -min(amount, time))
 
+    @db_method("time_db")
     def get_time(self, user):
-        entry = list(self.time_cursor.execute(
-            "SELECT time FROM time_watched WHERE username = ?", (user,)))
-        return entry[0]
+        time = self.time_cache.get(user)
+        if time is None:
+            raise IndexError("{} is not in the database".format(user))
+        return (time,)
+
+    @db_method("time_db")
+    def top_time(self, n=10):
+        """ Returns the (username, time) of the `n` longest watching users """
+        return self.time_cache.top(n)
+
+    @db_method("time_db")
+    def time_rank_of(self, user):
+        """
+        Returns the leaderboard position of a user, or None. See
+        `BalanceCache.rank_of` for the cost outside of the top.
+        """
+        return self.time_cache.rank_of(user)
 
+    @db_method("time_db")
     def save_time_database(self):
+        """ Write all changes now, they're written periodically anyway """
+        self.time_cache.flush()
         self.time_database.commit()
 
+    @db_method("time_db")
     def reset_time_database(self):
-        self.time_cursor.execute("DROP TABLE time_watched")
-        _setup_time_db(self.time_database_name)
+        self.time_cache.clear()
+        with self.time_database:
+            self.time_cursor.execute("DROP TABLE time_watched")
+            _create_time_table(self.time_cursor)
 
+    @db_method("time_db")
     def undo_time_database_changes(self):
+        """ Forget changes that weren't written yet """
+        self.time_cache.discard()
         self.time_database.rollback()
 
 
@@ -1293,56 +2851,209 @@ class RankedBot(ViewTimeBot, CurrencyBot):
         super().__init__(*args, **kwargs)
         self.autopoints = points_per_minute
         self.ranks_database_name = ranks_database
+        if self.remote_storage:
+            self.rank_db = None
+            return
         if not pathlib.Path(ranks_database).is_file():
             _setup_ranks_db(ranks_database)
-        self.rank_database = sqlite3.connect(ranks_database)
-        self.rank_cursor = self.rank_database.cursor()
-
+        self.rank_db = self._open_database("rank", ranks_database)
+        self.rank_database = self.rank_db.connection
+        self.rank_cursor = self.rank_db.run_sync(self.rank_database.cursor)
+        self.rank_db.run_sync(_migrate_ranks_db, self.rank_database)
+        self.time_db.run_sync(
+            self.time_database.execute, "ATTACH DATABASE ? AS points",
+            (self.currency_database_name,))
+        self.time_db.run_sync(
+            self.time_database.execute, "ATTACH DATABASE ? AS ranks",
+            (ranks_database,))
+
+        # (thresholds, names) sorted by threshold, see _load_ranks
+        self.currency_ranks = ([], [])
+        self.watched_ranks = ([], [])
+        # username -> rank name or None, only touched on the rank thread
+        self._user_ranks = collections.OrderedDict()
+        self.rank_db.run_sync(self._load_ranks)
+
+    def _load_ranks(self):
+        def load(table, column):
+            rows = self.rank_cursor.execute(
+                "SELECT {0}, rankname FROM {1} ORDER BY {0}, rowid".format(
+                    column, table)).fetchall()
+            return [row[0] for row in rows], [row[1] for row in rows]
+        # replaced as a whole, so the event loop never sees half a table
+        self.currency_ranks = load("currency_ranks", "currency")
+        self.watched_ranks = load("watched_ranks", "time")
+
+    def resolve_rank(self, balance, time):
+        """
+        Returns the rank for a balance and watch time, or None.
+
+        Watch time ranks take precedence over currency ranks.
+        """
+        for value, (thresholds, names) in (
+                (time, self.watched_ranks), (balance, self.currency_ranks)):
+            i = bisect.bisect_right(thresholds, value)
+            if i:
+                return names[i - 1]
+        return None
+
+    def _get_user_rank(self, user):
+        try:
+            rank = self._user_ranks[user]
+        except KeyError:
+            row = self.rank_cursor.execute(
+                "SELECT rankname FROM user_ranks WHERE username = ?",
+                (user,)).fetchone()
+            rank = row[0] if row else None
+        self._remember_rank(user, rank)
+        return rank
+
+    def _remember_rank(self, user, rank):
+        self._user_ranks[user] = rank
+        self._user_ranks.move_to_end(user)
+        if len(self._user_ranks) > self.balance_cache:
+            self._user_ranks.popitem(last=False)
+
+    @db_method("rank_db")
+    def get_user_rank(self, user):
+        """ Returns the rank of a user, or None """
+        return self._get_user_rank(user)
+
+    @db_method("rank_db")
     def check_user_rank(self, user, rank):
-        """ Check if the user is already in the database """
-        return bool(list(self.time_cursor.execute(
-            "SELECT * FROM user_ranks WHERE username = ? AND rank = ?",
-            (user, rank))))
+        """ Check if the user has this rank """
+        return self._get_user_rank(user) == rank
+
+    @db_method("rank_db")
+    def _set_user_rank(self, user, rank):
+        """ Store a rank, returns False if the user already had it """
+        if self._get_user_rank(user) == rank:
+            return False
+        with self.rank_database:
+            self.rank_cursor.execute(
+                "DELETE FROM user_ranks WHERE username = ?", (user,))
+            if rank is not None:
+                self.rank_cursor.execute(
+                    "INSERT INTO user_ranks VALUES (?,?)", (user, rank))
+        self._remember_rank(user, rank)
+        return True
 
     @asyncio.coroutine
     def autoset_user(self, user):
-        if not self.check_user_currency(user):
-            self.add_user_currency(user)
-        bal = self.get_currency(user)[0]
-        if not self.check_user_time(user):
-            self.add_user_time(user)
-        time = self.get_time(user)[0]
-        new_rank = None
-        for rank in list(self.rank_cursor.execute(
-                "SELECT * FROM currency_ranks ORDER BY currency")):
-            cur = rank[0]
-            if cur <= bal:
-                new_rank = rank[1]
-        for rank in list(self.rank_cursor.execute(
-                "SELECT * FROM watched_ranks ORDER BY time")):
-            tim = rank[0]
-            if tim <= time:
-                new_rank = rank[1]
+        new_rank = yield from self.db._autoset_rank(user)
         if new_rank:
-            if not self.check_user_rank(user, new_rank):
-                self.rank_cursor.execute(
-                    "DELETE FROM user_ranks WHERE user = ?", (user,))
-                self.rank_cursor.execute(
-                    "INSERT INTO user_ranks VALUES (?,?)", (user, new_rank))
             yield from self.event_rankup(user, new_rank)
 
+    @db_method("rank_db")
+    def _autoset_rank(self, user):
+        """ Rank a user, returns their new rank if it changed """
+        self.add_user_currency(user)
+        balance = self.get_currency(user)[0]
+        self.add_user_time(user)
+        watched = self.get_time(user)[0]
+        new_rank = self.resolve_rank(balance, watched)
+        if new_rank and self._set_user_rank(user, new_rank):
+            return new_rank
+        return None
+
+    def _rank_levels(self):
+        """ rank name -> how high it is, watch time ranks being highest """
+        levels = {None: (0, 0)}
+        for kind, (thresholds, names) in enumerate(
+                (self.currency_ranks, self.watched_ranks)):
+            for i, name in enumerate(names, 1):
+                levels[name] = max(levels.get(name, (0, 0)), (kind, i))
+        return levels
+
+    def _compute_ranks(self, currency_ranks, watched_ranks, chunk_size):
+        """ Returns (user, old rank, new rank) of every user whose rank
+            changed, runs on the time database thread """
+        cursor = self.time_database.execute(
+            "SELECT u.username, IFNULL(c.balance, 0), IFNULL(t.time, 0), "
+            "r.rankname FROM (SELECT username FROM points.currency UNION "
+            "SELECT username FROM time_watched) u "
+            "LEFT JOIN points.currency c USING (username) "
+            "LEFT JOIN time_watched t USING (username) "
+            "LEFT JOIN ranks.user_ranks r USING (username)")
+        changed = []
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            users, balances, times, old = zip(*rows)
+            new = _resolve_ranks(currency_ranks, watched_ranks,
+                                 balances, times)
+            changed.extend(
+                (users[i], old[i], new[i]) for i in range(len(rows))
+                if old[i] != new[i])
+        return changed
+
+    @db_method("rank_db")
+    def _write_ranks(self, changed):
+        """ Store changed ranks in one transaction """
+        with self.rank_database:
+            self.rank_cursor.executemany(
+                "DELETE FROM user_ranks WHERE username = ?",
+                [(user,) for user, _, _ in changed])
+            self.rank_cursor.executemany(
+                "INSERT INTO user_ranks VALUES (?,?)",
+                [(user, new) for user, _, new in changed if new is not None])
+        self._user_ranks.clear()
+
+    @asyncio.coroutine
+    def recompute_ranks(self, chunk_size=50000):
+        """
+        Recompute the rank of every user in one pass, e.g. after changing
+        the rank thresholds.
+
+        Only changed ranks are written, in one transaction, and
+        `event_rankup` is called for every user whose rank rose. Uses
+        NumPy if it is installed.
+
+        Parameters
+        ----------
+        chunk_size : Optional[int]
+            The amount of users to read and rank at once. (default: 50000)
+
+        Returns
+        -------
+        dict
+            The new rank of every user whose rank changed.
+        """
+        if self.remote_storage:
+            raise Exception("recompute_ranks runs on the ShardedRunner's "
+                            "store, not in workers")
+        # everything has to be written before it can be read back joined
+        yield from self.currency_db.run(self.currency_cache.flush)
+        yield from self.time_db.run(self.time_cache.flush)
+        yield from self.db.save_rank_database()
+
+        currency_ranks, watched_ranks = self.currency_ranks, self.watched_ranks
+        changed = yield from self.time_db.run(
+            self._compute_ranks, currency_ranks, watched_ranks, chunk_size)
+        if not changed:
+            return {}
+        yield from self.db._write_ranks(changed)
+
+        levels = self._rank_levels()
+        for user, old, new in changed:
+            if levels.get(new, (0, 0)) > levels.get(old, (0, 0)):
+                yield from self.event_rankup(user, new)
+        return {user: new for user, _, new in changed}
+
     @asyncio.coroutine
     def event_rankup(self, user, rank):
         pass
 
-    @asyncio.coroutine
-    def event_viewtime_update(self, users):
-        for user in users:
-            if not self.check_user_currency(user):
-                self.add_user_currency(user)
-            self.add_currency(user, self.autopoints)
-        self.save_currency_database()
+    @db_method("time_db")
+    def _accrue(self, users, seconds):
+        """ Add watch time and currency to every user """
+        super()._accrue(users, seconds)
+        self.currency_db.run_sync(
+            self.currency_cache.add_many,
+            [(user, self.autopoints) for user in users])
 
+    @db_method("rank_db")
     def add_rank(self, name, points=0, time_watched=0, type_rank='points'):
         if type_rank == 'points':
             self.rank_cursor.execute(
@@ -1354,15 +3065,276 @@ class RankedBot(ViewTimeBot, CurrencyBot):
         else:
             raise Exception(
                 "Invalid rank type! valid types: 'points', 'time_watched'.")
+        self._load_ranks()
 
+    @db_method("rank_db")
     def save_rank_database(self):
         self.rank_database.commit()
 
+    @db_method("rank_db")
     def reset_rank_database(self):
-        self.rank_cursor.execute("DROP TABLE currency_ranks")
-        self.rank_cursor.execute("DROP TABLE watched_ranks")
-        self.rank_cursor.execute("DROP TABLE user_ranks")
-        _setup_ranks_db(self.ranks_database_name)
-
+        with self.rank_database:
+            self.rank_cursor.execute("DROP TABLE currency_ranks")
+            self.rank_cursor.execute("DROP TABLE watched_ranks")
+            self.rank_cursor.execute("DROP TABLE user_ranks")
+            _create_rank_tables(self.rank_cursor)
+        self._user_ranks.clear()
+        self._load_ranks()
+
+    @db_method("rank_db")
     def undo_rank_database_changes(self):
-        self.rank_database.rollback()
\ No newline at end of file
+        self.rank_database.rollback()
+        self._user_ranks.clear()
+        self._load_ranks()
+
+
+class _OwnerProxy:
+    """ Forwards calls from a worker to the coordinator's state owner """
+
+    def __init__(self, loop, index, events):
+        self.loop = loop
+        self.index = index
+        self.events = events
+        self._calls = {}
+        self._ids = itertools.count()
+
+    @asyncio.coroutine
+    def call(self, name, *args):
+        """
+        Call a method on the shared state owner and wait for the result.
+
+        Parameters
+        ----------
+        name : str
+            The name of the method to call, e.g. `add_currency`.
+        """
+        call_id = next(self._ids)
+        future = asyncio.Future(loop=self.loop)
+        self._calls[call_id] = future
+        self.events.put(("owner", self.index, call_id, name, args))
+        return (yield from future)
+
+    def _resolve(self, call_id, result, error):
+        future = self._calls.pop(call_id, None)
+        if future is None or future.done():
+            return
+        if error is not None:
+            future.set_exception(Exception(error))
+        else:
+            future.set_result(result)
+
+
+@asyncio.coroutine
+def _worker_commands(bot, commands):
+    while True:
+        msg = yield from bot.loop.run_in_executor(None, commands.get)
+        kind = msg[0]
+        try:
+            if kind == "call":
+                _, name, args = msg
+                yield from getattr(bot, name)(*args)
+            elif kind == "reply":
+                _, call_id, result, error = msg
+                bot.owner._resolve(call_id, result, error)
+            elif kind == "stop":
+                bot.stop(exit=True)
+        except Exception as e:
+            yield from bot.parse_error(e)
+
+
+@asyncio.coroutine
+def _worker_metrics(bot, index, events, interval):
+    while True:
+        yield from asyncio.sleep(interval)
+        events.put(("metrics", index, {
+            "channels": len(bot.chan),
+            "connections": bot.connection_stats()}))
+
+
+def _worker_main(index, bot_class, kwargs, channels, commands, events,
+                 interval):
+    bot = bot_class(**dict(kwargs, channel=channels, remote_storage=True))
+    bot.shard_id = index
+    bot.owner = _OwnerProxy(bot.loop, index, events)
+    bot.loop.create_task(_worker_commands(bot, commands))
+    bot.loop.create_task(_worker_metrics(bot, index, events, interval))
+    bot.start()
+
+
+class ShardedRunner:
+    """
+    Runs a bot over several worker processes, each owning a slice of the
+    channels with its own event loop.
+
+    Outbound commands are forwarded to the worker owning the channel and
+    worker metrics are merged here. Calls that touch shared state go through
+    `bot.owner.call(...)` in the workers and are executed by a single owner
+    object in this process, so only the owner writes to its storage.
+
+    For :class:`CurrencyBot`, :class:`ViewTimeBot` and :class:`RankedBot`
+    this process also runs the databases, as `ShardedRunner.store`. In the
+    workers, `yield from bot.db.add_currency(...)` and the other database
+    methods as well as view time accrual are forwarded to it, while their
+    blocking versions raise. Chatters in channels of several workers
+    accrue view time once per worker.
+
+    .. code-block:: python
+
+        runner = ShardedRunner(MyBot, workers=4, owner=make_store,
+                               user='name', oauth='oauth:...',
+                               channel=channels)
+        runner.start()
+
+    Parameters
+    ----------
+    bot_class : type
+        The bot class to run, importable by the worker processes.
+    workers : Optional[int]
+        The amount of worker processes. (default: the amount of CPUs)
+    owner : Optional[callable]
+        Creates the object shared state calls are executed on.
+    metrics_interval : Optional[int]
+        Seconds between metric reports of each worker. (default: 10)
+    **kwargs
+        Passed to `bot_class`, `channel` is split over the workers.
+    """
+
+    def __init__(self, bot_class, workers=None, owner=None,
+                 metrics_interval=10, **kwargs):
+        self.bot_class = bot_class
+        self.workers = workers or multiprocessing.cpu_count()
+        self.owner_factory = owner
+        self.owner = None
+        self.store = None
+        self.metrics_interval = metrics_interval
+
+        channel = kwargs.pop("channel", None) or "twitch"
+        if isinstance(channel, str):
+            channel = [channel]
+        channels = ["#" + c.lower().strip('#') for c in channel]
+        self.kwargs = kwargs
+
+        self.slices = [channels[i::self.workers]
+                       for i in range(self.workers)]
+        self.slices = [s for s in self.slices if s]
+        self.routes = {c: i for i, s in enumerate(self.slices) for c in s}
+
+        self.events = multiprocessing.Queue()
+        self.commands = [multiprocessing.Queue() for _ in self.slices]
+        self.processes = []
+        self.worker_metrics = {}
+        self._running = False
+
+    def start(self):
+        """
+        Starts the workers and coordinates them until stopped.
+        """
+        for i, channels in enumerate(self.slices):
+            p = multiprocessing.Process(
+                target=_worker_main,
+                args=(i, self.bot_class, self.kwargs, channels,
+                      self.commands[i], self.events,
+                      self.metrics_interval),
+                daemon=True)
+            p.start()
+            self.processes.append(p)
+
+        if self.owner_factory is not None:
+            self.owner = self.owner_factory()
+        if issubclass(self.bot_class, (CurrencyBot, ViewTimeBot)):
+            # only opened here, after the workers were forked
+            self.store = self.bot_class(**dict(self.kwargs, channel=[]))
+
+        self._running = True
+        last_flush = time.monotonic()
+        try:
+            while self._running:
+                try:
+                    msg = self.events.get(timeout=1)
+                except queue.Empty:
+                    msg = ()
+                if msg is None:
+                    break
+                if msg:
+                    self._dispatch(msg)
+                if (self.store is not None and time.monotonic() - last_flush
+                        >= self.store.flush_interval):
+                    # the store's event loop doesn't run, flush from here
+                    self._flush_store()
+                    last_flush = time.monotonic()
+        finally:
+            if self.store is not None:
+                for db in self.store.databases.values():
+                    db.close()
+
+    def _flush_store(self):
+        for db in self.store.databases.values():
+            for cache in db.caches:
+                db.run_sync(cache.flush)
+
+    def _call_owner(self, name, args):
+        """ Run storage calls on the store, anything else on the owner """
+        if self.store is not None:
+            method = getattr(type(self.store), name, None)
+            if hasattr(method, "db_call"):
+                return method(self.store, *args)
+        if self.owner is None:
+            raise Exception("No owner to call {} on".format(name))
+        return getattr(self.owner, name)(*args)
+
+    def _dispatch(self, msg):
+        kind = msg[0]
+        if kind == "metrics":
+            _, index, stats = msg
+            self.worker_metrics[index] = stats
+        elif kind == "owner":
+            _, index, call_id, name, args = msg
+            try:
+                result = self._call_owner(name, args)
+            except Exception as e:
+                self.commands[index].put(("reply", call_id, None, repr(e)))
+            else:
+                self.commands[index].put(("reply", call_id, result, None))
+
+    def worker_for(self, channel):
+        """ Returns the index of the worker owning a channel """
+        return self.routes["#" + channel.lower().strip('#')]
+
+    def call(self, channel, name, *args):
+        """
+        Run a bot coroutine, such as `say`, on the worker owning a channel.
+        """
+        self.commands[self.worker_for(channel)].put(("call", name, args))
+
+    def say(self, channel, message):
+        """
+        Send a message through the worker owning the channel.
+        """
+        self.call(channel, "say", channel, message)
+
+    def metrics(self):
+        """
+        Returns the merged metrics of all workers.
+        """
+        totals = collections.Counter()
+        for stats in self.worker_metrics.values():
+            totals["channels"] += stats["channels"]
+            for conn in stats["connections"]:
+                totals["connections"] += 1
+                for key in ("lines_in", "lines_out", "bytes_in", "bytes_out"):
+                    totals[key] += conn[key]
+        return {"workers": dict(self.worker_metrics),
+                "totals": dict(totals)}
+
+    def stop(self):
+        """
+        Stops every worker and the coordinator.
+        """
+        for q in self.commands:
+            q.put(("stop",))
+        self._running = False
+        self.events.put(None)
+        for p in self.processes:
+            p.join(5)
+            if p.is_alive():
+                p.terminate()
@@ -1,4 +1,5 @@
 import asyncio
+import collections
 import uuid
 import datetime
 import inspect
@@ -11,14 +12,6 @@ except ImportError:
     print("To use music, please install isodate. (pip install isodate)")
     iso_installed = False
 
-try:
-    import aiohttp
-    aio_installed = True
-except ImportError:
-    print("To use stats from the API, make sure to install aiohttp. "
-          "(pip install aiohttp)")
-    aio_installed = False
-
 
 def _parse_badges(s):
     if not s:
@@ -31,31 +24,18 @@ def _parse_badges(s):
         return [Badge(*s.split("/"))]
 
 
-def _parse_emotes(s):
-    emotelist = []  # 25:8-12 354:14-18
+def _parse_emotes(s, content=None, catalogue=None):
+    emotelist = []  # 25:8-12,20-24/354:14-18
     if not s:
         return []
-    if "/" in s:
-        # multiple emotes
-        emotes = s.split("/")
-        for emote in emotes:
-            res = emote.split(":")
-            emote_id = res[0]
-            locations = res[1]
-            if "," in locations:
-                for loc in locations.split(","):
-                    emotelist.append(Emote(emote_id, loc))
-            else:
-                emotelist.append(Emote(emote_id, locations))
-    else:
-        res = s.split(":")
-        emote_id = res[0]
-        locations = res[1]
-        if "," in locations:
-            for loc in locations.split(","):
-                emotelist.append(Emote(emote_id, loc))
-        else:
-            emotelist.append(Emote(emote_id, locations))
+    for emote in str(s).split("/"):
+        emote_id, locations = emote.split(":")
+        for loc in locations.split(","):
+            text = None
+            if content is not None:
+                start, end = loc.split("-")
+                text = content[int(start):int(end) + 1]
+            emotelist.append(Emote(emote_id, loc, text, catalogue))
     return emotelist
 
 class Object:
@@ -66,6 +46,40 @@ class Object:
         for k,v in kwargs.items():
             setattr(self, k, v)
 
+class EmoteCatalogue:
+    """
+    Known emotes, indexed by id and by name.
+
+    Attributes
+    ----------
+    by_id : dict
+        Emote id -> name.
+    by_name : dict
+        Emote name -> id.
+    """
+
+    def __init__(self, emotes=None):
+        self.by_id = {}
+        self.by_name = {}
+        if emotes:
+            self.refresh(emotes)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def refresh(self, emotes):
+        """ Rebuild the indexes from a name -> {'image_id': id} mapping """
+        by_name = {k: int(v['image_id']) for k, v in emotes.items()}
+        self.by_id = {v: k for k, v in by_name.items()}
+        self.by_name = by_name
+
+    def name(self, emote_id):
+        return self.by_id.get(int(emote_id), "")
+
+    def id(self, name):
+        return self.by_name.get(name)
+
+
 class Emote:
     """
     A class to hold emote data
@@ -76,24 +90,25 @@ class Emote:
         The ID of the emote.
     location : str
         The location of the emote in the message.
+    text : str
+        The emote as written in the message.
     url : str
         The url of the emote.
     """
-    def __init__(self, id, loc):
+    def __init__(self, id, loc, text=None, catalogue=None):
         self.id = int(id)
         self.location = loc
+        self.text = text
+        self.catalogue = catalogue
         self.url = "https://static-cdn.jtvnw.net/emoticons/v1/{}/3.0".format(
             id)
 
     def __str__(self):
-        global emotes
-        if not aio_installed:
-            raise Exception("Please install aiohttp to use this feature")
-        else:
-            for k, v in emotes.items():
-                if v['image_id'] == self.id:
-                    return k
-            return ""
+        if self.text is not None:
+            return self.text
+        if self.catalogue is not None:
+            return self.catalogue.name(self.id)
+        return ""
 
 
 class Badge:
@@ -440,38 +455,284 @@ class Song:
             os.remove(file)
 
 
+class MessageCache:
+    """
+    A fixed size ring buffer of messages, indexed by message id and author.
+
+    Inserting and evicting are O(1) and keep the indexes in sync.
+
+    Parameters
+    ----------
+    capacity : int
+        The amount of messages to keep.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._ring = [None] * capacity
+        self._next = 0
+        self._size = 0
+        self._by_id = {}
+        self._by_author = {}
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        """ Iterate from oldest to newest """
+        start = (self._next - self._size) % self.capacity
+        for i in range(self._size):
+            yield self._ring[(start + i) % self.capacity]
+
+    def append(self, message):
+        """ Add a message, evicting the oldest one when full """
+        old = self._ring[self._next]
+        if old is not None:
+            self._evict(old)
+        else:
+            self._size += 1
+        self._ring[self._next] = message
+        self._next = (self._next + 1) % self.capacity
+
+        message_id = getattr(message, "id", None)
+        if message_id is not None:
+            self._by_id[message_id] = message
+        self._by_author.setdefault(
+            message.author.name, collections.deque()).append(message)
+
+    def _evict(self, message):
+        message_id = getattr(message, "id", None)
+        if self._by_id.get(message_id) is message:
+            del self._by_id[message_id]
+        messages = self._by_author[message.author.name]
+        messages.popleft()  # authors' messages are evicted in order too
+        if not messages:
+            del self._by_author[message.author.name]
+
+    def get(self, message_id):
+        """ Returns the cached message with this id, or None """
+        if isinstance(message_id, str):
+            message_id = uuid.UUID(message_id)
+        return self._by_id.get(message_id)
+
+    def by_author(self, name, limit=None):
+        """ Returns the last `limit` cached messages of a user, oldest first """
+        messages = self._by_author.get(name)
+        if not messages:
+            return []
+        if limit is None or limit >= len(messages):
+            return list(messages)
+        return list(messages)[-limit:]
+
+
+class RosterDiff:
+    """
+    Changes between two chatter lists of a channel.
+
+    Attributes
+    ----------
+    joined : dict
+        Name -> role of users that appeared.
+    left : dict
+        Name -> role of users that are gone.
+    changed : dict
+        Name -> (old role, new role) of users whose role changed.
+    """
+
+    def __init__(self, joined, left, changed):
+        self.joined = joined
+        self.left = left
+        self.changed = changed
+
+    def __bool__(self):
+        return bool(self.joined or self.left or self.changed)
+
+
+class Roster:
+    """
+    The chatters of a channel, held as a set per role.
+
+    `name in roster` is O(1).
+    """
+
+    roles = ('viewers', 'moderators', 'staff', 'admins', 'global_moderators')
+
+    def __init__(self):
+        self.by_role = {r: set() for r in self.roles}
+        self._roles = {}
+
+    def __contains__(self, name):
+        return name in self._roles
+
+    def __iter__(self):
+        return iter(self._roles)
+
+    def __len__(self):
+        return len(self._roles)
+
+    def role(self, name):
+        """ Returns the role of a chatter, or None """
+        return self._roles.get(name)
+
+    def update(self, chatters):
+        """
+        Replace the chatters and return a :class:`RosterDiff`.
+
+        Parameters
+        ----------
+        chatters : dict
+            Role -> iterable of names.
+        """
+        new = {}
+        by_role = {r: set() for r in self.roles}
+        for role, names in chatters.items():
+            names = set(names)
+            by_role[role] = names
+            for name in names:
+                new[name] = role
+
+        old = self._roles
+        joined = {n: new[n] for n in new.keys() - old.keys()}
+        left = {n: old[n] for n in old.keys() - new.keys()}
+        changed = {n: (old[n], new[n]) for n in new.keys() & old.keys()
+                   if old[n] != new[n]}
+
+        self._roles = new
+        self.by_role = by_role
+        return RosterDiff(joined, left, changed)
+
+
+class ChannelState:
+    """
+    Per-channel data, allocated when the channel is first used and released
+    when the bot leaves it.
+
+    Attributes
+    ----------
+    name : str
+        The channel name, including `#`.
+    stats : dict
+        Channel information from the API.
+    viewer_count : int
+        The amount of chatters.
+    host_count : int
+        The amount of channels hosting this channel.
+    roster : :class:`Roster`
+        Chatters by role.
+    hosts : list
+        Names of the channels hosting this channel.
+    messages : :class:`MessageCache`
+        Recent messages, None until the first message arrives.
+    activity : int
+        Messages received since the channel was last polled.
+    poll_interval : int
+        Seconds until the channel is polled again.
+    """
+
+    __slots__ = ("name", "stats", "viewer_count", "host_count", "roster",
+                 "hosts", "messages", "activity", "poll_interval")
+
+    def __init__(self, name):
+        self.name = name
+        self.stats = {}
+        self.viewer_count = 0
+        self.host_count = 0
+        self.roster = Roster()
+        self.hosts = []
+        self.messages = None
+        self.activity = 0
+        self.poll_interval = 0
+
+    @property
+    def viewers(self):
+        """ Chatter names by role, as lists """
+        return {r: list(names) for r, names in self.roster.by_role.items()}
+
+    @property
+    def moderators(self):
+        return list(self.roster.by_role['moderators'])
+
+
 class User:
     """ Custom user class """
 
+    _fields = (('mod', 'mod'), ('subscriber', 'subscriber'),
+               ('type', 'user-type'), ('turbo', 'turbo'), ('id', 'user-id'))
+
     def __init__(self, a, channel, tags=None):
         self.name = a
         self.channel = channel
+        self._raw_badges = self._raw_color = None
         if tags:
-            self.badges = _parse_badges(tags['badges'])
-            self.color = Color(tags['color'])
-            self.mod = tags['mod']
-            self.subscriber = tags['subscriber']
-            self.type = tags['user-type']
-            try:
-                self.turbo = tags['turbo']
-                self.id = tags['user-id']
-            except:
-                pass
+            self.update(tags)
+
+    def update(self, tags):
+        """ Update the user from message tags, only re-parsing what changed """
+        badges = tags.get('badges')
+        if badges != self._raw_badges or not hasattr(self, 'badges'):
+            self.badges = _parse_badges(badges)
+            self._raw_badges = badges
+        color = tags.get('color')
+        if color != self._raw_color or not hasattr(self, 'color'):
+            self.color = Color(color)
+            self._raw_color = color
+        for attr, key in self._fields:
+            if key in tags:
+                setattr(self, attr, tags[key])
+
+
+class UserRegistry:
+    """
+    A bounded LRU registry of users, so every message of a user shares the
+    same :class:`User` object.
+
+    Parameters
+    ----------
+    maxlen : Optional[int]
+        The amount of users to keep. (default: 10000)
+    """
+
+    def __init__(self, maxlen=10000):
+        self.maxlen = maxlen
+        self._users = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._users)
+
+    def get(self, name, channel, tags=None):
+        """ Returns the user, creating or updating it as needed """
+        key = (channel, name)
+        user = self._users.get(key)
+        if user is None:
+            user = self._users[key] = User(name, channel, tags)
+            if len(self._users) > self.maxlen:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(key)
+            if tags:
+                user.update(tags)
+        return user
+
+    def forget_channel(self, channel):
+        """ Drop every user of a channel """
+        channel = channel.strip("#")
+        for key in [k for k in self._users if k[0] == channel]:
+            del self._users[key]
 
 
 class Message:
     """ Custom message object to combine message, author and timestamp """
 
-    def __init__(self, m, a, channel, tags):
+    def __init__(self, m, a, channel, tags, author=None, emotes=None):
         if tags:
             self.raw_timestamp = tags['tmi-sent-ts']
             self.timestamp = datetime.datetime.fromtimestamp(
                 int(tags['tmi-sent-ts']) / 1000)
-            self.emotes = _parse_emotes(tags['emotes'])
+            self.emotes = _parse_emotes(tags['emotes'], m, emotes)
             self.id = uuid.UUID(tags['id'])
             self.room_id = tags['room-id']
         self.content = m
-        self.author = User(a, channel, tags)
+        self.author = author or User(a, channel, tags)
         self.channel = channel
 
     def __str__(self):
@@ -0,0 +1,680 @@
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import datetime
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from .dataclasses import Object
+
+
+# ON CONFLICT ... DO UPDATE was added in SQLite 3.24
+_has_upsert = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+
+def _add_amounts(cursor, table, column, rows):
+    """ Add (username, amount) rows to a column, inserting missing users """
+    if _has_upsert:
+        cursor.executemany(
+            "INSERT INTO {0} VALUES (?,?) ON CONFLICT(username) "
+            "DO UPDATE SET {1} = {1} + excluded.{1}".format(table, column),
+            rows)
+    else:
+        rows = list(rows)
+        cursor.executemany(
+            "INSERT OR IGNORE INTO {} VALUES (?,0)".format(table),
+            [(user,) for user, _ in rows])
+        cursor.executemany(
+            "UPDATE {0} SET {1} = {1} + ? WHERE username = ?".format(
+                table, column),
+            [(amount, user) for user, amount in rows])
+
+
+def _set_amounts(cursor, table, column, rows):
+    """ Set (username, amount) rows, inserting missing users """
+    if _has_upsert:
+        cursor.executemany(
+            "INSERT INTO {0} VALUES (?,?) ON CONFLICT(username) "
+            "DO UPDATE SET {1} = excluded.{1}".format(table, column), rows)
+    else:
+        cursor.executemany(
+            "INSERT OR REPLACE INTO {} VALUES (?,?)".format(table), rows)
+
+
+def _timestamp(value):
+    """ datetime or epoch seconds to epoch seconds """
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    return value
+
+
+class Database:
+    """
+    Runs all access to one SQLite database on a dedicated thread.
+
+    Calls are queued and run one at a time in order, so a slow query or
+    fsync never blocks the event loop.
+
+    Parameters
+    ----------
+    path : str
+        The database file to use.
+    loop : :class:`asyncio.AbstractEventLoop`
+        The loop to run on.
+    wal : Optional[bool]
+        Use write-ahead logging, so readers don't wait for writers.
+        (default: False)
+    """
+
+    def __init__(self, path, loop, wal=False):
+        self.path = path
+        self.loop = loop
+        self.wal = wal
+        self.connection = None
+        self.caches = []
+        self.queries = 0
+        self.submitted = 0
+        self.query_times = collections.deque(maxlen=200)
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._thread = None
+        self.run_sync(self._open)
+
+    def _open(self):
+        self._thread = threading.get_ident()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        if self.wal:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+
+    def _timed(self, func, args, kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.query_times.append(time.perf_counter() - start)
+            self.queries += 1
+
+    def submit(self, func, *args, **kwargs):
+        """ Queue a call, returns a :class:`concurrent.futures.Future` """
+        self.submitted += 1
+        return self._executor.submit(self._timed, func, args, kwargs)
+
+    @asyncio.coroutine
+    def run(self, func, *args, **kwargs):
+        """ Run a call on the database thread and wait for its result """
+        return (yield from asyncio.wrap_future(
+            self.submit(func, *args, **kwargs), loop=self.loop))
+
+    def run_sync(self, func, *args, **kwargs):
+        """ Run a call on the database thread, blocking until it's done """
+        if threading.get_ident() == self._thread:
+            return func(*args, **kwargs)
+        return self.submit(func, *args, **kwargs).result()
+
+    def _execute(self, sql, args):
+        return self.connection.execute(sql, args).fetchall()
+
+    @asyncio.coroutine
+    def execute(self, sql, args=()):
+        """ Run a statement, returns all resulting rows """
+        return (yield from self.run(self._execute, sql, args))
+
+    @asyncio.coroutine
+    def executemany(self, sql, rows):
+        yield from self.run(self.connection.executemany, sql, rows)
+
+    @asyncio.coroutine
+    def commit(self):
+        yield from self.run(self.connection.commit)
+
+    def stats(self):
+        """
+        Returns the queue depth, the amount of calls run and the mean and
+        maximum duration of recent calls in seconds.
+        """
+        times = list(self.query_times)
+        return {
+            "queue_depth": self.submitted - self.queries,
+            "queries": self.queries,
+            "latency_mean": sum(times) / len(times) if times else None,
+            "latency_max": max(times) if times else None}
+
+    def close(self):
+        """ Run the queued calls, flush all caches and close the database """
+        if self.connection is not None:
+            for cache in self.caches:
+                cache.close()
+            self.submit(self.connection.close)
+        self._executor.shutdown(wait=True)
+        self.connection = None
+
+
+class BalanceCache:
+    """
+    Keeps a (username, amount) column in memory and writes changes back in
+    batches.
+
+    Changes are kept as pending deltas, so adding to a user never has to
+    read them first. Pending deltas are written in one transaction every
+    `flush_interval` seconds, or as soon as `batch_size` users changed.
+    Values read from the database are kept in a LRU of `maxlen` users.
+
+    The `top_size` highest users are kept sorted in memory as well and
+    updated as amounts change, so leaderboards rarely need the database.
+
+    Every method except :meth:`close` must run on the thread of `db`.
+
+    Parameters
+    ----------
+    db : :class:`Database`
+        The database the table is in.
+    table : str
+        The table to cache.
+    column : str
+        The amount column of the table.
+    maxlen : Optional[int]
+        The amount of users to keep values of. (default: 10000)
+    flush_interval : Optional[int]
+        Seconds between writes of pending changes. (default: 5)
+    batch_size : Optional[int]
+        Write as soon as this many users have pending changes.
+        (default: 1000)
+    top_size : Optional[int]
+        The amount of highest users to keep sorted. (default: 100)
+    """
+
+    def __init__(self, db, table, column, maxlen=10000, flush_interval=5,
+                 batch_size=1000, top_size=100):
+        self.db = db
+        self.table = table
+        self.column = column
+        self.maxlen = maxlen
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.top_size = top_size
+
+        # (-amount, username) of the highest users, None until needed or
+        # after a change that can't be tracked. Users outside of it have
+        # at most _bound.
+        self._top = None
+        self._top_values = {}
+        self._bound = float("-inf")
+
+        # username -> amount including pending changes, None if missing
+        self.values = collections.OrderedDict()
+        # username -> pending change
+        self.dirty = {}
+        self.flushes = 0
+
+        db.caches.append(self)
+        self._task = db.loop.create_task(self._flush_task())
+
+    def _remember(self, user, value):
+        self.values[user] = value
+        self.values.move_to_end(user)
+        if len(self.values) > self.maxlen:
+            self.values.popitem(last=False)
+
+    def get(self, user):
+        """ Returns the amount of a user, or None if they're not stored """
+        try:
+            value = self.values[user]
+        except KeyError:
+            pass
+        else:
+            self.values.move_to_end(user)
+            return value
+        row = self.db.connection.execute(
+            "SELECT {} FROM {} WHERE username = ?".format(
+                self.column, self.table), (user,)).fetchone()
+        if row is not None:
+            value = row[0] + self.dirty.get(user, 0)
+        elif user in self.dirty:
+            value = self.dirty[user]
+        else:
+            value = None
+        self._remember(user, value)
+        return value
+
+    def __contains__(self, user):
+        return self.get(user) is not None
+
+    def add(self, user, amount):
+        """ Add to a user, adding the user if needed """
+        if (self._top is not None and amount > 0 and
+                user not in self.values and user not in self._top_values):
+            # needed to tell whether they enter the top
+            self.get(user)
+        self._add(user, amount)
+        if len(self.dirty) >= self.batch_size:
+            self.flush()
+
+    def add_many(self, rows):
+        """ Add (username, amount) rows """
+        for user, amount in rows:
+            if (amount > 0 and user not in self.values and
+                    user not in self._top_values):
+                # too many unknown amounts to read, rebuild when needed
+                self._top = None
+            self._add(user, amount)
+        if len(self.dirty) >= self.batch_size:
+            self.flush()
+
+    def _add(self, user, amount, pending=True):
+        if pending:
+            self.dirty[user] = self.dirty.get(user, 0) + amount
+        if user in self.values:
+            value = (self.values[user] or 0) + amount
+            self.values[user] = value
+            self._track(user, value)
+        elif user in self._top_values:
+            self._track(user, self._top_values[user] + amount)
+
+    def add_now(self, rows):
+        """
+        Add (username, amount) rows in one transaction right away,
+        bypassing the pending changes.
+        """
+        rows = list(rows)
+        with self.db.connection:
+            _add_amounts(self.db.connection, self.table, self.column, rows)
+        for user, amount in rows:
+            if (amount > 0 and user not in self.values and
+                    user not in self._top_values):
+                self._top = None
+            self._add(user, amount, pending=False)
+
+    def set_now(self, rows):
+        """
+        Set (username, amount) rows in one transaction right away,
+        replacing their pending changes.
+        """
+        rows = list(rows)
+        with self.db.connection:
+            _set_amounts(self.db.connection, self.table, self.column, rows)
+        for user, value in rows:
+            self.dirty.pop(user, None)
+            self._remember(user, value)
+            self._track(user, value)
+
+    def _track(self, user, value):
+        """ Update the top for a user's new amount """
+        if self._top is None:
+            return
+        old = self._top_values.pop(user, None)
+        if old is not None:
+            del self._top[bisect.bisect_left(self._top, (-old, user))]
+        if value < self._bound:
+            return
+        bisect.insort(self._top, (-value, user))
+        self._top_values[user] = value
+        if len(self._top) > self.top_size:
+            lowest, dropped = self._top.pop()
+            del self._top_values[dropped]
+            self._bound = max(self._bound, -lowest)
+
+    def _rebuild_top(self):
+        self.flush()
+        rows = self.db.connection.execute(
+            "SELECT username, {0} FROM {1} ORDER BY {0} DESC LIMIT ?".format(
+                self.column, self.table), (self.top_size,)).fetchall()
+        self._top = sorted((-value, user) for user, value in rows)
+        self._top_values = dict(rows)
+        if len(rows) < self.top_size:
+            self._bound = float("-inf")
+        else:
+            self._bound = rows[-1][1]
+
+    def top(self, n=10):
+        """ Returns the (username, amount) of the `n` highest users """
+        if n > self.top_size:
+            self.flush()
+            return self.db.connection.execute(
+                "SELECT username, {0} FROM {1} ORDER BY {0} DESC "
+                "LIMIT ?".format(self.column, self.table), (n,)).fetchall()
+        if self._top is None or (n > len(self._top) and
+                                 self._bound != float("-inf")):
+            self._rebuild_top()
+        return [(user, -value) for value, user in self._top[:n]]
+
+    def rank_of(self, user):
+        """
+        Returns the position of a user, 1 being the highest, or None if
+        they're not stored. Users with equal amounts share a position.
+
+        Users in the top are answered from memory in O(log n). For anyone
+        else the users above them are counted through the index. That
+        costs O(k) for k users above them, which is close to every user
+        for the lowest ones. Those counts use written amounts, so other
+        users' changes from the last `flush_interval` seconds may be
+        missing.
+        """
+        value = self.get(user)
+        if value is None:
+            return None
+        if self._top is None:
+            self._rebuild_top()
+        if user in self._top_values:
+            return bisect.bisect_left(self._top, (-value,)) + 1
+        return self.db.connection.execute(
+            "SELECT COUNT(*) FROM {} WHERE {} > ?".format(
+                self.table, self.column), (value,)).fetchone()[0] + 1
+
+    def flush(self):
+        """ Write all pending changes in one transaction """
+        if not self.dirty:
+            return
+        rows, self.dirty = list(self.dirty.items()), {}
+        with self.db.connection:
+            _add_amounts(self.db.connection, self.table, self.column, rows)
+        self.flushes += 1
+
+    def discard(self):
+        """ Forget all pending changes """
+        self.dirty = {}
+        self.values.clear()
+        self._top = None
+        self._top_values = {}
+
+    def clear(self):
+        """ Forget everything, e.g. after the table was recreated """
+        self.discard()
+
+    @asyncio.coroutine
+    def _flush_task(self):
+        while True:
+            yield from asyncio.sleep(self.flush_interval, loop=self.db.loop)
+            yield from self.db.run(self.flush)
+
+    def close(self):
+        """ Stop flushing periodically and queue a final flush """
+        self._task.cancel()
+        self.db.submit(self.flush)
+
+
+def db_method(database):
+    """
+    Runs a bot method on the thread of the :class:`Database` stored in the
+    `database` attribute, blocking until it's done. The awaitable version
+    is available as `bot.db.<name>`.
+    """
+    def decorator(func):
+        def wrapper(self, *args, **kwargs):
+            db = getattr(self, database)
+            if db is None:
+                raise Exception(
+                    "Storage is run by the shard owner, use "
+                    "`yield from bot.db.{}(...)` instead".format(
+                        func.__name__))
+            return db.run_sync(func, self, *args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.db_call = (database, func)
+        return wrapper
+    return decorator
+
+
+class AsyncDatabaseMethods:
+    """
+    Awaitable versions of a bot's database methods.
+
+    .. code-block:: python
+
+        await bot.db.add_currency('user', 10)
+        balance = (await bot.db.get_currency('user'))[0]
+
+    In :class:`ShardedRunner` workers the calls are forwarded to the
+    runner's store through `bot.owner`, positional arguments only.
+    """
+
+    def __init__(self, bot):
+        self._bot = bot
+
+    def __getattr__(self, name):
+        method = getattr(type(self._bot), name, None)
+        if not hasattr(method, "db_call"):
+            raise AttributeError(
+                "{} is not a database method".format(name))
+        database, func = method.db_call
+        bot = self._bot
+        if getattr(bot, database) is None and bot.owner is not None:
+            return functools.partial(bot.owner.call, name)
+
+        @asyncio.coroutine
+        def call(*args, **kwargs):
+            return (yield from getattr(bot, database).run(
+                func, bot, *args, **kwargs))
+        return call
+
+    def stats(self):
+        """ Returns :meth:`Database.stats` of every database by name """
+        return {name: db.stats() for name, db in self._bot.databases.items()}
+
+
+class MetadataCache:
+    """
+    Caches JSON responses on disk, one file per url.
+
+    Every entry keeps the time it was fetched, its time to live and the
+    ETag/Last-Modified validators, so stale entries can be revalidated.
+
+    Parameters
+    ----------
+    directory : str
+        The directory to store entries in.
+    ttl : Optional[int]
+        Default seconds until an entry is stale. (default: 3600)
+    """
+
+    def __init__(self, directory, ttl=3600):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, url):
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + ".json")
+
+    def get(self, url):
+        """ Returns the entry for a url, stale or not, or None """
+        try:
+            with open(self._path(url)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_fresh(self, entry):
+        return time.time() - entry['fetched_at'] < entry['ttl']
+
+    def put(self, url, data, ttl=None, etag=None, last_modified=None):
+        """ Store a response """
+        entry = {
+            'url': url,
+            'fetched_at': time.time(),
+            'ttl': ttl or self.ttl,
+            'etag': etag,
+            'last_modified': last_modified,
+            'data': data}
+        path = self._path(url)
+        with open(path + ".tmp", "w") as f:
+            json.dump(entry, f)
+        os.replace(path + ".tmp", path)
+
+    def touch(self, url):
+        """ Mark an entry as fresh again, e.g. after a 304 """
+        entry = self.get(url)
+        if entry is not None:
+            self.put(url, entry['data'], entry['ttl'], entry['etag'],
+                     entry['last_modified'])
+
+
+class HistoryStore:
+    """
+    Stores chat messages in a SQLite database.
+
+    Messages are queued in memory and written in batches through a
+    :class:`Database`, so disk access never blocks the event loop.
+
+    Parameters
+    ----------
+    path : str
+        The database file to use.
+    loop : :class:`asyncio.AbstractEventLoop`
+        The loop to run on.
+    batch_size : Optional[int]
+        Write as soon as this many messages are queued. (default: 500)
+    flush_interval : Optional[int]
+        Seconds between writes of queued messages. (default: 5)
+    """
+
+    def __init__(self, path, loop, batch_size=500, flush_interval=5):
+        self.path = path
+        self.loop = loop
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.db = Database(path, loop)
+        self._pending = []
+        self.db.run_sync(self._open)
+        self._task = loop.create_task(self._flush_task())
+
+    def _open(self):
+        self._con = self.db.connection
+        self._con.execute(
+            "CREATE TABLE IF NOT EXISTS messages (id TEXT, channel TEXT, "
+            "author TEXT, timestamp REAL, content TEXT)")
+        self._con.execute(
+            "CREATE INDEX IF NOT EXISTS messages_channel "
+            "ON messages (channel, timestamp)")
+        self._con.execute(
+            "CREATE INDEX IF NOT EXISTS messages_author "
+            "ON messages (channel, author, timestamp)")
+        self._con.commit()
+
+    def _write(self, rows):
+        with self._con:
+            self._con.executemany(
+                "INSERT INTO messages VALUES (?,?,?,?,?)", rows)
+
+    def append(self, message):
+        """ Queue a message to be stored """
+        try:
+            ts = int(message.raw_timestamp) / 1000
+        except AttributeError:
+            ts = time.time()
+        self._pending.append((
+            str(getattr(message, "id", "")) or None,
+            "#" + message.channel.strip("#"),
+            message.author.name,
+            ts,
+            message.content))
+        if len(self._pending) >= self.batch_size:
+            self.loop.create_task(self.flush())
+
+    @asyncio.coroutine
+    def flush(self):
+        """ Write all queued messages """
+        if not self._pending:
+            return
+        rows, self._pending = self._pending, []
+        yield from self.db.run(self._write, rows)
+
+    @asyncio.coroutine
+    def _flush_task(self):
+        while True:
+            yield from asyncio.sleep(self.flush_interval, loop=self.loop)
+            yield from self.flush()
+
+    def history(self, channel, author=None, since=None, limit=100,
+                page_size=200):
+        """
+        Query stored messages, oldest first.
+
+        .. code-block:: python
+
+            async for m in store.history('#channel', author='user'):
+                print(m.timestamp, m.content)
+
+        Parameters
+        ----------
+        channel : str
+            The channel to search.
+        author : Optional[str]
+            Only return messages by this user.
+        since : Optional[datetime.datetime, float]
+            Only return messages sent after this time.
+        limit : Optional[int]
+            The maximum amount of messages to return. (default: 100)
+        """
+        return _HistoryQuery(self, "#" + channel.lower().strip("#"), author,
+                             _timestamp(since), limit, page_size)
+
+    def close(self):
+        """ Write the remaining messages and close the database """
+        self._task.cancel()
+        rows, self._pending = self._pending, []
+        if rows:
+            self.db.submit(self._write, rows)
+        self.db.close()
+
+
+class _HistoryQuery:
+    """ Streams query results page by page """
+
+    def __init__(self, store, channel, author, since, limit, page_size):
+        self.store = store
+        self.channel = channel
+        self.author = author
+        self.since = since
+        self.remaining = limit
+        self.page_size = page_size
+        self._page = []
+        self._cursor = None
+        self._flushed = False
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def _fetch(self):
+        sql = "SELECT rowid, id, author, timestamp, content FROM messages " \
+              "WHERE channel = ?"
+        args = [self.channel]
+        if self.author is not None:
+            sql += " AND author = ?"
+            args.append(self.author)
+        if self._cursor is not None:
+            sql += " AND (timestamp > ? OR (timestamp = ? AND rowid > ?))"
+            args.extend([self._cursor[0], self._cursor[0], self._cursor[1]])
+        elif self.since is not None:
+            sql += " AND timestamp > ?"
+            args.append(self.since)
+        sql += " ORDER BY timestamp, rowid LIMIT ?"
+        args.append(min(self.page_size, self.remaining))
+        return (yield from self.store.db.execute(sql, args))
+
+    @asyncio.coroutine
+    def __anext__(self):
+        if not self._flushed:
+            # include messages that are still queued
+            yield from self.store.flush()
+            self._flushed = True
+        if not self._page:
+            if self.remaining <= 0:
+                raise StopAsyncIteration
+            self._page = list(reversed((yield from self._fetch())))
+            if not self._page:
+                raise StopAsyncIteration
+        rowid, message_id, author, ts, content = self._page.pop()
+        self._cursor = (ts, rowid)
+        self.remaining -= 1
+        return Object(id=message_id, channel=self.channel, author=author,
+                      timestamp=datetime.datetime.fromtimestamp(ts),
+                      content=content)
@@ -0,0 +1,86 @@
+""" Benchmark CurrencyBot storage with a large amount of users.
+
+    python bench_currency.py --users 1000000 --ops 100000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+import asynctwitch as at
+
+
+def timed(label, ops, func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print("{:<28} {:>10.0f} ops/s  ({:.2f}s)".format(
+        label, ops / elapsed, elapsed))
+
+
+def legacy_db(path, users):
+    """ The schema before usernames had a primary key """
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE currency (username VARCHAR(30), balance INT)")
+    con.executemany("INSERT INTO currency VALUES (?,0)",
+                    (("user{}".format(i),) for i in range(users)))
+    con.commit()
+    con.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--ops", type=int, default=100000)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "points.db")
+
+    timed("create legacy database", args.users,
+          lambda: legacy_db(path, args.users))
+
+    bot = None
+
+    def open_bot():
+        nonlocal bot
+        bot = at.CurrencyBot(user="justinfan1", points_database=path)
+
+    timed("migrate to primary key", args.users, open_bot)
+
+    names = ["user{}".format(random.randrange(args.users))
+             for _ in range(args.ops)]
+
+    def add():
+        for name in names:
+            bot.add_currency(name, 10)
+        bot.save_currency_database()
+
+    def get():
+        for name in names:
+            bot.get_currency(name)
+
+    def remove():
+        for name in names:
+            bot.remove_currency(name, 1, force_remove=True)
+        bot.save_currency_database()
+
+    def new_users():
+        for i in range(args.ops):
+            bot.add_currency("new{}".format(i), 1)
+        bot.save_currency_database()
+
+    timed("add_currency", args.ops, add)
+    timed("get_currency", args.ops, get)
+    timed("remove_currency", args.ops, remove)
+    timed("add_currency (new users)", args.ops, new_users)
+
+    bot.currency_db.close()
+    os.remove(path)
+    os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    main()